@@ -19,16 +19,23 @@
 # along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
 
 # Standard library imports.
-from collections import defaultdict
 import random
 
 # Local library imports.
-from .data import getdata, MASCULINE, FEMININE, NEUTER, GENDERS
+from . import instrument
+from .data import (build_db, data_version, import_corpus, DEFAULT_DBFILE,
+                   MASCULINE, FEMININE, NEUTER, GENDERS)
+from .corpus import Corpus
+from .filters import NameFilter, get_filter_index
+from .pools import load_pools
 
 __all__ = ['__version__', '__author__', '__copyright__',
            'MASCULINE', 'FEMININE', 'NEUTER', 'GENDERS',
            'FORMATS', 'NAME_PARTS', 'NATIONALITIES',
-           'generate', 'nat_lookup']
+           'Corpus', 'GenerationPlan', 'NameFilter', 'constrained_choices',
+           'default_pools', 'generate', 'get_plan',
+           'import_corpus', 'nat_lookup', 'refresh_pools', 'reload_pools',
+           'resolve_pools']
 
 __version__ = '0.2'
 __author__ = 'Timothy Pederick'
@@ -122,7 +129,229 @@ NAT_ABBREVS = {'hy': 'Armenian', 'hye': 'Armenian', 'arm': 'Armenian',
 # the corresponding full name is returned.
 nat_lookup = lambda nat: NAT_ABBREVS.get(nat, nat)
 
-def generate(nationality=None, gender=None, verbosity=0):
+class GenerationPlan:
+    '''A precompiled recipe for names of one nationality and gender.
+
+    A plan holds, for each format offered by its nationality, the pool to
+    draw each name part from and the earlier positions in the format
+    whose names that part must not repeat. Running a plan needs no
+    further lookups in FORMATS, NAME_PARTS or the data.
+
+    A plan compiled with constraints draws each constrained part from
+    the subset of its pool that meets them, found through the pools'
+    filter index (see get_filter_index()).
+
+    '''
+    __slots__ = ('pools', 'nationality', 'gender', 'constraints', 'formats')
+
+    def __init__(self, pools, nationality, gender, constraints=None):
+        '''Compile a plan.
+
+        Arguments:
+            pools -- The NamePools to draw names from.
+            nationality, gender -- The kind of name to generate.
+            constraints -- A NameFilter restricting the names chosen.
+                Formats that can't be filled from the names meeting the
+                constraints are left out of the plan.
+        Raises:
+            KeyError -- If the nationality is unknown.
+            ValueError -- If the pools lack enough names to fill some
+                format or, with constraints, to fill any format.
+
+        '''
+        self.pools = pools
+        self.nationality = nationality
+        self.gender = gender
+        self.constraints = constraints
+        index = None if constraints is None else get_filter_index(pools)
+
+        formats = []
+        for fmt in FORMATS[nationality]:
+            steps = []
+            for i, part in enumerate(fmt):
+                key = (NAME_PARTS[part], nationality, gender)
+                if constraints is not None and constraints.applies_to(part):
+                    pool = index.subset(*key, constraints)
+                else:
+                    pool = pools.pool(*key)
+                avoid = tuple(j for j in range(i) if fmt[j] == part)
+                distinct = len(set(pools.name_id(n) for n in pool))
+                if distinct <= len(avoid):
+                    if constraints is None:
+                        raise ValueError('not enough {} {} names for format '
+                                         '{}'.format(nationality, part, fmt))
+                    break
+                steps.append((pool, avoid))
+            else:
+                formats.append((fmt, tuple(steps)))
+        if not formats:
+            raise ValueError('not enough {} names meet the constraints '
+                             '{}'.format(nationality, constraints))
+        self.formats = tuple(formats)
+
+    def run(self, rng=random):
+        '''Choose a format and a record for each of its parts.
+
+        Arguments:
+            rng -- The random number generator to use (an instance of
+                random.Random, or the random module itself).
+        Returns:
+            A 2-tuple of the chosen format and a list of record numbers.
+
+        '''
+        index = rng.randrange(len(self.formats))
+        return self.formats[index][0], self.run_format(index, rng)
+
+    def run_format(self, index, rng=random):
+        '''Choose a record for each part of a given format.
+
+        Arguments:
+            index -- The index of the format in this plan's formats.
+            rng -- The random number generator to use.
+        Returns:
+            A list of record numbers.
+
+        '''
+        name_id = self.pools.name_id
+        steps = self.formats[index][1]
+        chosen = []
+        for pool, avoid in steps:
+            n = rng.choice(pool)
+            # Redraw until this name differs from those in the same role.
+            while any(name_id(n) == name_id(chosen[j]) for j in avoid):
+                n = rng.choice(pool)
+            chosen.append(n)
+        return chosen
+
+def get_plan(nationality, gender, pools=None, constraints=None):
+    '''Get the (cached) generation plan for a nationality and gender.
+
+    Keyword arguments:
+        pools -- The NamePools (or Corpus) to draw names from. If
+            omitted, the pools from the default database are used.
+        constraints -- A NameFilter restricting the names chosen.
+
+    '''
+    pools = resolve_pools(pools)
+    # Plans are cached with the pools they refer to (see NamePools).
+    key = ('plan', nationality, gender, constraints)
+    try:
+        return pools.derived[key]
+    except KeyError:
+        with instrument.span('generate.plan'):
+            plan = GenerationPlan(pools, nationality, gender, constraints)
+        pools.derived[key] = plan
+        return plan
+
+def constrained_choices(constraints, nationality=None, gender=None,
+                        pools=None):
+    '''List the kinds of name that can be generated under constraints.
+
+    Arguments:
+        constraints -- A NameFilter.
+        nationality, gender -- Fixed values for these name parameters,
+            if any; None allows any value.
+        pools -- The NamePools (or Corpus) to draw names from. If
+            omitted, the pools from the default database are used.
+    Returns:
+        A tuple of (nationality, gender) pairs whose plans can meet the
+        constraints.
+    Raises:
+        ValueError -- If no such pair exists.
+
+    '''
+    pools = resolve_pools(pools)
+    key = ('choices', nationality, gender, constraints)
+    try:
+        return pools.derived[key]
+    except KeyError:
+        pass
+    choices = []
+    for nat in (NATIONALITIES if nationality is None else (nationality,)):
+        for gen in ((MASCULINE, FEMININE) if gender is None else (gender,)):
+            try:
+                get_plan(nat, gen, pools, constraints)
+            except ValueError:
+                continue
+            choices.append((nat, gen))
+    if not choices:
+        raise ValueError('no {}names meet the constraints {}'.format(
+            '' if nationality is None else nationality + ' ', constraints))
+    choices = pools.derived[key] = tuple(choices)
+    return choices
+
+_default_pools = None
+
+def default_pools():
+    '''Get the pools loaded from the default database.
+
+    The pools are loaded (and the database built, if need be) the first
+    time this function is called.
+
+    '''
+    global _default_pools
+    if _default_pools is None:
+        _default_pools = load_pools()
+    return _default_pools
+
+def resolve_pools(pools=None):
+    '''Get the NamePools that a pools argument refers to.
+
+    Arguments:
+        pools -- A NamePools, a Corpus (whose pools are loaded, or
+            fetched from its engine cache) or None (for the pools from
+            the default database).
+
+    '''
+    if pools is None:
+        return default_pools()
+    elif isinstance(pools, Corpus):
+        return pools.pools()
+    return pools
+
+def reload_pools(rebuild=False, verbosity=0):
+    '''Replace the default pools with freshly loaded ones.
+
+    The new pools are loaded in full before being swapped in, so callers
+    never see a partly loaded state. Generation already under way
+    finishes with the pools it started with, which are discarded once
+    nothing refers to them.
+
+    Keyword arguments:
+        rebuild -- If true, rebuild the default database from the CSV
+            files first.
+        verbosity -- The amount of diagnostic output.
+    Returns:
+        The new pools.
+
+    '''
+    global _default_pools
+    if rebuild:
+        build_db(verbosity=verbosity)
+    pools = load_pools(verbosity=verbosity)
+    # Assigning a global is atomic, so readers see either the old pools or
+    # the new ones.
+    _default_pools = pools
+    return pools
+
+def refresh_pools(verbosity=0):
+    '''Reload the default pools if the default database has changed.
+
+    This is cheap enough to call periodically (or before each batch) in
+    a long-running process.
+
+    Returns:
+        True if the pools were reloaded.
+
+    '''
+    if (_default_pools is not None and
+        data_version(DEFAULT_DBFILE) == _default_pools.version):
+        return False
+    reload_pools(verbosity=verbosity)
+    return True
+
+def generate(nationality=None, gender=None, verbosity=0, pools=None,
+             romanisation=None, constraints=None):
     '''Generate a random name.
 
     Keyword arguments:
@@ -131,6 +360,17 @@ def generate(nationality=None, gender=None, verbosity=0):
         verbosity -- A numeric value that sets the amount of diagnostic
             detail dumped to standard output. The default is 0, for no
             output.
+        pools -- A NamePools instance (such as pools attached from
+            shared memory) or a Corpus to draw names from. If omitted,
+            the pools from the default database are used.
+        romanisation -- The identifier of a transliteration ruleset
+            (such as 'ru_BGN_PCGN') to romanise the name with, where
+            that ruleset applies to the nationality. If omitted, the
+            romanisations given in the data files are used.
+        constraints -- A NameFilter restricting the names chosen (for
+            example, to those with a given initial). Names are drawn
+            directly from those meeting the constraints; a ValueError
+            is raised if there are too few of them.
     Returns:
         A 5-tuple containing:
             * A sequence of name parts in the original script
@@ -142,43 +382,36 @@ def generate(nationality=None, gender=None, verbosity=0):
               parts)
 
     '''
+    pools = resolve_pools(pools)
+    if romanisation is not None and not pools.has_romanisations(romanisation):
+        # Compile the romanisation table for this ruleset, once.
+        pools.precompute_romanisations([romanisation])
+    if nationality is not None:
+        nationality = nat_lookup(nationality)
+    if constraints is not None and (nationality is None or gender is None):
+        # Randomly choose among the kinds of name that can meet the
+        # constraints.
+        nationality, gender = random.choice(
+            constrained_choices(constraints, nationality, gender, pools))
     # If given a nationality, use it (possibly after converting it from an
     # abbreviation); otherwise, randomly choose one.
-    nationality = (nat_lookup(nationality) if nationality is not None else
-                   random.choice(NATIONALITIES))
+    if nationality is None:
+        nationality = random.choice(NATIONALITIES)
     # If given a gender, use it; otherwise, randomly choose one.
     if gender is None:
         gender = random.choice([MASCULINE, FEMININE])
 
-    # Randomly choose a format out of those offered by the nationality.
-    fmt = random.choice(FORMATS[nationality])
+    # Run the plan for this nationality and gender, which randomly chooses a
+    # format and a (non-repetitive) record for each part of it.
+    with instrument.span('generate.format'):
+        fmt, chosen = get_plan(nationality, gender, pools,
+                               constraints).run()
+    if verbosity > 1:
+        print('Chose format {} and records {}'.format(fmt, chosen))
 
-    # Prepare to store the resulting name, in the original script and (where
+    # Collect the resulting name, in the original script and (where
     # relevant) in Latin transcription.
-    original_parts = []
-    romanised_parts = []
-
-    # Keep track of names we've seen, indexed by name part, to avoid giving
-    # repetitive names.
-    seen_names = defaultdict(list)
-
-    # Iterate over the different name parts in the chosen format.
-    for part in fmt:
-        # Look up the data source for this name part.
-        source = NAME_PARTS[part]
-        # Grab one random entry from the database.
-        random_choices = getdata(source, gender=gender,
-                                 nationality=nationality,
-                                 not_name=seen_names[part], randomise=True,
-                                 limit=1, verbosity=verbosity)
-        # Use the first (and only) result that the database returned.
-        chosen = next(random_choices)
-        # Add it to our seen list.
-        seen_names[part].append(chosen.name)
-
-        # And add it to the result.
-        original_parts.append(chosen.name)
-        if chosen.romanisation != '':
-            romanised_parts.append(chosen.romanisation)
+    original_parts, romanised_parts = pools.assemble(chosen, romanisation)
 
+    instrument.count('names_generated')
     return (original_parts, romanised_parts, gender, nationality, fmt)
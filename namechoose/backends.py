@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+'''Interchangeable storage backends for the namechoose data.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from abc import ABC, abstractmethod
+import os
+import os.path
+import random
+
+# Local library imports.
+from . import shared
+from .data import getdata, data_version, DATA_DIR, DEFAULT_DBFILE, NEUTER
+from .pools import load_pools
+
+__all__ = ['Backend', 'SQLiteBackend', 'MemoryBackend', 'SnapshotBackend',
+           'BACKENDS', 'DEFAULT_SNAPSHOT', 'get_backend']
+
+DEFAULT_SNAPSHOT = os.path.join(DATA_DIR, 'namechoose.pools')
+
+# The environment variable that selects a backend when none is named.
+BACKEND_ENVVAR = 'NAMECHOOSE_BACKEND'
+
+class Backend(ABC):
+    '''The interface provided by every storage backend.
+
+    Records are returned as namedtuples, as getdata() returns them.
+    Gender matching follows getdata(): a masculine or feminine gender
+    also matches neuter names. Subclasses must implement query(),
+    sample() and pools().
+
+    '''
+    name = None
+
+    @abstractmethod
+    def query(self, source, nationality=None, gender=None, exclude=(),
+              limit=None):
+        '''Fetch records from a data source.
+
+        Keyword arguments:
+            source -- The data source (e.g. 'personal').
+            nationality, gender -- If given, only records with these
+                values are returned.
+            exclude -- Names to leave out of the results.
+            limit -- The maximum number of records to return.
+        Returns:
+            A list of records, in storage order.
+
+        '''
+
+    @abstractmethod
+    def sample(self, source, nationality=None, gender=None, exclude=(), k=1):
+        '''Fetch up to k distinct records, chosen at random.
+
+        The arguments are as for query().
+
+        '''
+
+    @abstractmethod
+    def pools(self):
+        '''Get a NamePools holding this backend's data, for generation.'''
+
+    def reload(self):
+        '''Switch to the current version of the data.
+
+        Queries already under way finish with the version they started
+        with.
+
+        '''
+        pass
+
+    def close(self):
+        '''Release any resources held by the backend.'''
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+class SQLiteBackend(Backend):
+    '''Query the SQLite database directly, on every call.'''
+    name = 'sqlite'
+
+    def __init__(self, dbfilename=DEFAULT_DBFILE):
+        self.dbfilename = dbfilename
+        self._pools = None
+
+    def _getdata(self, source, nationality, gender, exclude, **kwargs):
+        '''Translate backend arguments into a getdata() call.'''
+        criteria = {}
+        if nationality is not None:
+            criteria['nationality'] = nationality
+        if gender is not None:
+            criteria['gender'] = gender
+        if len(exclude) > 0:
+            criteria['not_name'] = list(exclude)
+        return list(getdata(source, dbfilename=self.dbfilename, **kwargs,
+                            **criteria))
+
+    def query(self, source, nationality=None, gender=None, exclude=(),
+              limit=None):
+        return self._getdata(source, nationality, gender, exclude,
+                             limit=limit)
+
+    def sample(self, source, nationality=None, gender=None, exclude=(), k=1):
+        return self._getdata(source, nationality, gender, exclude,
+                             randomise=True, limit=k)
+
+    def pools(self):
+        if self._pools is None:
+            self._pools = load_pools(self.dbfilename)
+        return self._pools
+
+    def reload(self):
+        # Queries always see the current database; only the pools for
+        # generation need replacing.
+        self._pools = None
+
+class MemoryBackend(Backend):
+    '''Answer queries from name pools held in memory.'''
+    name = 'memory'
+
+    def __init__(self, dbfilename=DEFAULT_DBFILE, pools=None):
+        '''Load the data.
+
+        Keyword arguments:
+            dbfilename -- The database to load the pools from.
+            pools -- Existing NamePools to use instead of loading.
+
+        '''
+        self.dbfilename = dbfilename
+        self._pools = load_pools(dbfilename) if pools is None else pools
+
+    def _rows(self, source, nationality, gender, exclude):
+        '''Get the numbers of the records matching the criteria.'''
+        p = self._pools
+        if nationality is not None and gender is not None:
+            candidates = p.pool(source, nationality, gender)
+        else:
+            candidates = (row for row in range(len(p))
+                          if p.source(row) == source and
+                          (nationality is None or
+                           p.nationality(row) == nationality) and
+                          (gender is None or
+                           p.gender(row) in (gender, NEUTER)))
+        if len(exclude) == 0:
+            return list(candidates)
+        exclude = set(exclude)
+        return [row for row in candidates if p.name(row) not in exclude]
+
+    def query(self, source, nationality=None, gender=None, exclude=(),
+              limit=None):
+        rows = sorted(self._rows(source, nationality, gender, exclude))
+        if limit is not None:
+            rows = rows[:abs(int(limit))]
+        return [self._pools.record(row).astuple() for row in rows]
+
+    def sample(self, source, nationality=None, gender=None, exclude=(), k=1):
+        rows = self._rows(source, nationality, gender, exclude)
+        return [self._pools.record(row).astuple()
+                for row in random.sample(rows, min(k, len(rows)))]
+
+    def pools(self):
+        return self._pools
+
+    def reload(self):
+        # Load the new pools in full, then swap the reference.
+        self._pools = load_pools(self.dbfilename)
+
+class SnapshotBackend(MemoryBackend):
+    '''Answer queries from a memory-mapped snapshot of the name pools.
+
+    The snapshot file is written from the database if it does not
+    exist, or if it was written from an older version of the database
+    (see data_version()). Processes mapping the same snapshot share its
+    memory.
+
+    '''
+    name = 'snapshot'
+
+    def __init__(self, dbfilename=DEFAULT_DBFILE, snapshot=DEFAULT_SNAPSHOT,
+                 rebuild=False):
+        '''Map the snapshot.
+
+        Keyword arguments:
+            dbfilename -- The database to write the snapshot from.
+            snapshot -- The snapshot file name.
+            rebuild -- If true, rewrite the snapshot even if it exists.
+
+        '''
+        self.snapshot = snapshot
+        pools = None
+        if not rebuild and os.path.isfile(snapshot):
+            pools = shared.open_mapped(snapshot)
+            if pools.version != data_version(dbfilename):
+                # The database has been rebuilt or added to since.
+                pools.close()
+                pools = None
+        if pools is None:
+            shared.save(load_pools(dbfilename), snapshot)
+            pools = shared.open_mapped(snapshot)
+        super().__init__(dbfilename=dbfilename, pools=pools)
+
+    def reload(self):
+        # Write a new snapshot (which atomically replaces the old file) and
+        # map it. The old mapping stays valid for queries still using it,
+        # and is unmapped once nothing refers to it.
+        shared.save(load_pools(self.dbfilename), self.snapshot)
+        self._pools = shared.open_mapped(self.snapshot)
+
+    def close(self):
+        self._pools.close()
+
+# Backend classes by name.
+BACKENDS = {cls.name: cls for cls in (SQLiteBackend, MemoryBackend,
+                                      SnapshotBackend)}
+
+def get_backend(name=None, **options):
+    '''Create a storage backend.
+
+    Arguments:
+        name -- The backend's name: 'sqlite', 'memory' or 'snapshot'. If
+            omitted, the NAMECHOOSE_BACKEND environment variable is
+            consulted, and failing that, 'sqlite' is used.
+        Any keyword arguments are passed to the backend's constructor.
+
+    '''
+    if name is None:
+        name = os.environ.get(BACKEND_ENVVAR, 'sqlite')
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError("unknown storage backend '{}'".format(name))
+    return cls(**options)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+'''Generate random names in bulk.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+import random
+
+# Local library imports.
+from . import (instrument, FORMATS, NATIONALITIES, MASCULINE, FEMININE,
+               constrained_choices, get_plan, nat_lookup, resolve_pools)
+
+__all__ = ['BACKENDS', 'AliasTable', 'generate_many', 'parse_mix']
+
+BACKENDS = ('numpy', 'python')
+
+# The number of names generated at a time by the NumPy backend. Larger batches
+# amortise more overhead, at the expense of memory.
+DEFAULT_BATCH_SIZE = 10000
+
+# NumPy is optional; without it, the pure Python backend is used. Importing it
+# takes longer than starting namechoose, so it is only imported when a batch
+# first needs it (see _have_numpy()).
+numpy = None
+_numpy_tried = False
+
+def _have_numpy():
+    '''Import NumPy, if not yet tried, and check whether it is installed.'''
+    global numpy, _numpy_tried
+    if not _numpy_tried:
+        try:
+            import numpy
+        except ImportError:
+            pass
+        _numpy_tried = True
+    return numpy is not None
+
+class AliasTable:
+    '''A table for drawing from a discrete distribution in constant time.
+
+    Built with Vose's alias method: each of n slots holds a probability
+    and an alias, so a draw takes one uniform slot choice and one biased
+    coin flip, however many outcomes there are.
+
+    '''
+    __slots__ = ('prob', 'alias', '_np_tables')
+
+    def __init__(self, weights):
+        '''Build the table.
+
+        Arguments:
+            weights -- A sequence of non-negative weights, one per
+                outcome, not all zero. They need not sum to 1.
+
+        '''
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0 or any(w < 0 for w in weights):
+            raise ValueError('weights must be non-negative and not all zero')
+        scaled = [w * n / total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+        # Anything left over is 1 but for rounding error.
+        self._np_tables = None
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self, rng=random):
+        '''Draw one outcome (an index into the weights).'''
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+    def sample_array(self, rng, size):
+        '''Draw many outcomes at once, using a NumPy Generator.'''
+        if self._np_tables is None:
+            _have_numpy()
+            self._np_tables = (numpy.asarray(self.prob),
+                               numpy.asarray(self.alias, dtype=numpy.intp))
+        prob, alias = self._np_tables
+        i = rng.integers(len(prob), size=size)
+        return numpy.where(rng.random(size) < prob[i], i, alias[i])
+
+def parse_mix(spec):
+    '''Read a distribution of nationalities.
+
+    Arguments:
+        spec -- Either a string such as 'en=0.6,es=0.2,ja=0.2', or a
+            mapping of nationalities to weights. Nationalities may be
+            given as full names or ISO 639 codes. Weights need not sum
+            to 1.
+    Returns:
+        A dictionary mapping full nationality names to weights.
+    Raises:
+        ValueError -- If the spec is malformed, names an unknown
+            nationality or has no positive weights.
+
+    '''
+    if isinstance(spec, str):
+        items = []
+        for item in spec.split(','):
+            nat, sep, weight = item.partition('=')
+            if not sep:
+                raise ValueError("expected NATIONALITY=WEIGHT, found "
+                                 "'{}'".format(item))
+            try:
+                items.append((nat.strip(), float(weight)))
+            except ValueError:
+                raise ValueError("invalid weight '{}' for "
+                                 "'{}'".format(weight, nat.strip()))
+    else:
+        items = spec.items()
+
+    mix = {}
+    for nat, weight in items:
+        nat = nat_lookup(nat)
+        if nat not in FORMATS:
+            raise ValueError("unknown nationality '{}'".format(nat))
+        if weight < 0:
+            raise ValueError("negative weight for '{}'".format(nat))
+        mix[nat] = mix.get(nat, 0) + weight
+    if sum(mix.values()) <= 0:
+        raise ValueError('no nationality has a positive weight')
+    return mix
+
+def generate_many(count, nationality=None, gender=None, pools=None,
+                  backend=None, seed=None, batch_size=DEFAULT_BATCH_SIZE,
+                  romanisation=None, constraints=None, mix=None):
+    '''Generate many random names.
+
+    Each name's nationality, gender and format are drawn together from
+    one alias table (see AliasTable), and names are produced in the
+    order drawn, so different kinds of name come out interleaved.
+
+    Keyword arguments:
+        count -- The number of names to generate.
+        nationality, gender -- Specify values for these two name
+            parameters. If omitted, random values are chosen for each
+            name.
+        pools -- A NamePools instance or a Corpus to draw names from.
+            If omitted, the pools from the default database are used.
+        backend -- Either 'numpy' or 'python'. If omitted, NumPy is used
+            if it is installed.
+        seed -- A seed for the random number generator, for
+            reproducible output.
+        batch_size -- The number of names the NumPy backend generates at
+            a time (at least 1).
+        romanisation -- The identifier of a transliteration ruleset to
+            romanise names with, where it applies (see generate()).
+        constraints -- A NameFilter restricting the names chosen (see
+            generate()).
+        mix -- The proportion of names to generate of each nationality,
+            in any form accepted by parse_mix(). Nationalities not
+            listed are not generated. This can't be combined with a
+            nationality.
+    Returns:
+        An iterator over 5-tuples, as returned by generate().
+
+    '''
+    if backend is None:
+        backend = 'numpy' if _have_numpy() else 'python'
+    elif backend not in BACKENDS:
+        raise ValueError("unknown backend '{}'".format(backend))
+    elif backend == 'numpy' and not _have_numpy():
+        raise ImportError('the numpy backend requires NumPy')
+    if batch_size < 1:
+        raise ValueError('batch size must be positive')
+
+    pools = resolve_pools(pools)
+    if romanisation is not None:
+        # Compile the romanisation table for this ruleset, if need be.
+        pools.precompute_romanisations([romanisation])
+    if nationality is not None:
+        if mix is not None:
+            raise ValueError('a nationality and a mix cannot both be given')
+        nationality = nat_lookup(nationality)
+        if nationality not in FORMATS:
+            raise ValueError("unknown nationality '{}'".format(nationality))
+    if mix is not None:
+        mix = parse_mix(mix)
+        required = [nat for nat, weight in mix.items() if weight > 0]
+    else:
+        mix = {nat: 1 for nat in (NATIONALITIES if nationality is None
+                                  else (nationality,))}
+        required = ()
+
+    # The kinds of name to choose between.
+    if constraints is not None:
+        # Only those that can meet the constraints (checked now, rather than
+        # part way through).
+        choices = constrained_choices(constraints, nationality, gender, pools)
+        for nat in required:
+            if not any(c[0] == nat for c in choices):
+                raise ValueError('no {} names meet the constraints '
+                                 '{}'.format(nat, constraints))
+    else:
+        choices = tuple((nat, gen) for nat in mix
+                        for gen in ((MASCULINE, FEMININE) if gender is None
+                                    else (gender,)))
+
+    # Every (plan, format) pair that may be drawn. A nationality's weight is
+    # shared equally between its genders, and then between their formats.
+    genders_per_nat = {}
+    for nat, gen in choices:
+        genders_per_nat[nat] = genders_per_nat.get(nat, 0) + 1
+    outcomes, weights = [], []
+    for nat, gen in choices:
+        if mix.get(nat, 0) <= 0:
+            continue
+        plan = get_plan(nat, gen, pools, constraints)
+        for f in range(len(plan.formats)):
+            outcomes.append((plan, f))
+            weights.append(mix[nat] / genders_per_nat[nat] /
+                           len(plan.formats))
+    table = AliasTable(weights)
+
+    if backend == 'numpy':
+        return _generate_numpy(count, outcomes, table, pools, seed,
+                               batch_size, romanisation)
+    else:
+        return _generate_python(count, outcomes, table, pools, seed,
+                                romanisation)
+
+def _generate_python(count, outcomes, table, pools, seed, romanisation):
+    '''Generate names one at a time, in pure Python.'''
+    rng = random.Random(seed)
+    for _ in range(count):
+        plan, f = outcomes[table.sample(rng)]
+        fmt, nat, gen = plan.formats[f][0], plan.nationality, plan.gender
+        chosen = plan.run_format(f, rng)
+        original_parts, romanised_parts = pools.assemble(chosen,
+                                                         romanisation)
+        instrument.count('names_generated')
+        yield (original_parts, romanised_parts, gen, nat, fmt)
+
+def _generate_numpy(count, outcomes, table, pools, seed, batch_size,
+                    romanisation):
+    '''Generate names in vectorised batches, using NumPy.'''
+    rng = numpy.random.default_rng(seed)
+    # Plan pools converted to NumPy index arrays, built on first use.
+    np_pools = {}
+    # The name string ID of every record, for detecting repeated names.
+    name_ids = numpy.asarray(pools.name_ids, dtype=numpy.intp)
+
+    remaining = count
+    while remaining > 0:
+        size = min(remaining, batch_size)
+        remaining -= size
+
+        with instrument.span('batch.draw'):
+            # Draw the nationality, gender and format of every name in the
+            # batch at once.
+            codes = table.sample_array(rng, size)
+
+            # For each row, the record index of each name part. Unused
+            # trailing parts are left as -1.
+            max_parts = max(len(fmt) for fmts in FORMATS.values()
+                            for fmt in fmts)
+            parts = numpy.full((size, max_parts), -1, dtype=numpy.intp)
+
+            for code in numpy.unique(codes).tolist():
+                plan, f = outcomes[code]
+                rows = numpy.flatnonzero(codes == code)
+                _draw_parts(rng, np_pools, name_ids, code, plan.formats[f][1],
+                            rows, parts)
+
+        # Only now are the chosen records turned into strings, in the order
+        # drawn.
+        with instrument.span('batch.materialise'):
+            names = []
+            for code, row in zip(codes.tolist(), parts.tolist()):
+                plan, f = outcomes[code]
+                fmt = plan.formats[f][0]
+                original_parts, romanised_parts = pools.assemble(
+                    row[:len(fmt)], romanisation)
+                names.append((original_parts, romanised_parts, plan.gender,
+                              plan.nationality, fmt))
+            instrument.count('names_generated', size)
+        yield from names
+
+def _draw_parts(rng, np_pools, name_ids, step_key, steps, rows, parts):
+    '''Draw record indices for every part of one format, for many rows.
+
+    Arguments:
+        step_key -- A key identifying the plan and format, under which
+            its pools are cached in np_pools.
+        steps -- The steps of the format in its generation plan, each a
+            pool and the earlier positions it must not repeat.
+
+    Repeated parts (e.g. two personal names) are kept distinct by
+    redrawing, in bulk, every row that collides with an earlier part.
+    The plan has already checked that each pool has enough distinct
+    names for this to finish.
+
+    '''
+    for i, (plan_pool, earlier) in enumerate(steps):
+        try:
+            pool = np_pools[step_key, i]
+        except KeyError:
+            pool = np_pools[step_key, i] = numpy.asarray(plan_pool,
+                                                         dtype=numpy.intp)
+
+        drawn = pool[rng.integers(len(pool), size=len(rows))]
+        redo = numpy.arange(len(rows)) if earlier else ()
+        while len(redo) > 0:
+            clash = numpy.zeros(len(redo), dtype=bool)
+            for j in earlier:
+                clash |= (name_ids[drawn[redo]] ==
+                          name_ids[parts[rows[redo], j]])
+            redo = redo[clash]
+            drawn[redo] = pool[rng.integers(len(pool), size=len(redo))]
+        parts[rows, i] = drawn
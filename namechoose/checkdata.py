@@ -22,16 +22,18 @@
 from functools import lru_cache
 import os.path
 import re
+import random
 import sqlite3
 import sys
+import time
 
 # Local library imports.
 from . import (GENDERS, MASCULINE, FEMININE, NEUTER, FORMATS, NAME_PARTS,
                NATIONALITIES)
-from .data import getdata, DEFAULT_DBFILE, DATA_COLUMNS
+from .data import build_db, getdata, DEFAULT_DBFILE, DATA_COLUMNS
 from . import translit
 
-__all__ = ['validate_data']
+__all__ = ['validate_data', 'check_backend', 'benchmark_backend']
 
 TABLES = ('PersonalNames', 'AdditionalNames', 'FamilyNames', 'PMatronymics')
 
@@ -206,37 +208,129 @@ def validate_data(dbfilename=DEFAULT_DBFILE, verbosity=0):
             sources_to_check = set(NAME_PARTS[part] for fmt in fmts
                                    for part in fmt)
 
-            for source in sources_to_check:
+            pairs = []
+            for source in sorted(sources_to_check):
                 cur = conn.cursor()
                 cur.execute('SELECT name'
                             ' , romanisation'
                             ' FROM "{}"'
                             ' WHERE nationality = ?'.format(source),
                             (nat,))
-                for row in cur:
-                    if verbosity > 1:
-                        print("\t'{}' to '{}': ".format(row['name'],
-                                                        row['romanisation']),
-                              end='')
-
-                    if not translit.is_translit(row['romanisation'],
-                                                row['name'], ruleset_id):
-                        expected_translit = translit.translit(row['name'],
-                                                              ruleset_id)
-                        if verbosity > 1:
-                            print("no, got '{}'".format(expected_translit))
-
-                        print("WARNING: {0} name '{1[name]}' is romanised as "
-                              "'{1[romanisation]}', expected "
-                              "'{2}'".format(nat, row, expected_translit),
-                              file=sys.stderr)
-                    elif verbosity > 1:
-                        print('OK')
+                pairs.extend(cur)
+            mismatches = translit.check_translits(pairs, ruleset_id)
+            if verbosity > 1:
+                print('\t{} of {} names OK'.format(len(pairs) -
+                                                   len(mismatches),
+                                                   len(pairs)))
+            for mismatch in mismatches:
+                print("WARNING: {0} name '{1.name}' is romanised as "
+                      "'{1.romanisation}', expected "
+                      "'{1.expected}'".format(nat, mismatch),
+                      file=sys.stderr)
+
+        # 7. Can every transliteration rule take effect? (Rules shadowed by
+        # earlier ones never do, but are still tried on every character.)
+        if verbosity:
+            print('Checking for dead transliteration rules...')
+        for ruleset_id in translit.ruleset_ids():
+            if verbosity > 1:
+                print("\tChecking ruleset '{}'".format(ruleset_id))
+            for problem in translit.lint_ruleset(ruleset_id):
+                print("WARNING: transliteration rule {0.index} "
+                      "('{0.pattern}') in ruleset '{1}' {2}".format(
+                          problem, ruleset_id, _describe_rule_problem(problem)),
+                      file=sys.stderr)
 
     finally:
         # Do not commit! No changes should have been made anyway.
         conn.close()
 
+def _describe_rule_problem(problem):
+    '''Explain why a transliteration rule can never take effect.'''
+    culprits = ', '.join(str(index) for index in problem.culprits)
+    if problem.problem == 'empty':
+        return 'matches the empty string'
+    elif problem.problem == 'duplicate':
+        return 'duplicates rule {}'.format(culprits)
+    return 'is shadowed by rule{} {}'.format(
+        's' if len(problem.culprits) > 1 else '', culprits)
+
+def check_backend(backend, reference, verbosity=0):
+    '''Check that a storage backend behaves the same as a reference one.
+
+    Every combination of data source, nationality and gender (including
+    unspecified ones) is queried from both backends. The full results,
+    limits, exclusions and random samples are compared.
+
+    Returns:
+        The number of problems found (each of which is also reported).
+
+    '''
+    problems = 0
+    def problem(message, *args):
+        nonlocal problems
+        problems += 1
+        print(('ERROR: {} backend: ' + message).format(backend.name, *args),
+              file=sys.stderr)
+
+    for source in DATA_COLUMNS:
+        if verbosity:
+            print("Checking '{}' names from the {} backend against the {} "
+                  "backend...".format(source, backend.name, reference.name))
+        for nat in [None] + NATIONALITIES:
+            for gender in (None,) + tuple(GENDERS):
+                expected = reference.query(source, nat, gender)
+                actual = backend.query(source, nat, gender)
+                if sorted(actual) != sorted(expected):
+                    problem("query({!r}, {!r}, {!r}) returned {} records, "
+                            "expected {}", source, nat, gender, len(actual),
+                            len(expected))
+                    continue
+                if len(expected) == 0:
+                    continue
+
+                limited = backend.query(source, nat, gender, limit=2)
+                if len(limited) != min(2, len(expected)):
+                    problem('limit=2 returned {} records', len(limited))
+
+                excluded = expected[0].name
+                for record in backend.query(source, nat, gender,
+                                            exclude=[excluded]):
+                    if record.name == excluded:
+                        problem("exclude=[{!r}] was not honoured", excluded)
+                        break
+
+                sample = backend.sample(source, nat, gender, k=2)
+                if (len(sample) != min(2, len(expected)) or
+                    any(record not in expected for record in sample) or
+                    len(set(sample)) != len(sample)):
+                    problem('sample({!r}, {!r}, {!r}, k=2) returned '
+                            '{!r}', source, nat, gender, sample)
+    return problems
+
+def benchmark_backend(backend, repeat=200, seed=None):
+    '''Time a storage backend's queries and samples.
+
+    The same pseudo-random sequence of (source, nationality, gender)
+    combinations is used for every backend given the same seed.
+
+    Returns:
+        A dictionary mapping 'query' and 'sample' to the mean time taken
+        per call, in seconds.
+
+    '''
+    rng = random.Random(seed)
+    combos = [(rng.choice(sorted(DATA_COLUMNS)), rng.choice(NATIONALITIES),
+               rng.choice([MASCULINE, FEMININE])) for _ in range(repeat)]
+    timings = {}
+    for method in ('query', 'sample'):
+        call = getattr(backend, method)
+        start = time.perf_counter()
+        for combo in combos:
+            call(*combo)
+        timings[method] = (time.perf_counter() - start) / repeat
+    return timings
+
 def check_for_script_mixing(s):
     '''Check a string for mixed scripts.'''
     IGNORABLE = ['Common', 'Inherited', 'Unknown']
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+'''Generate names from several databases (corpora) in one process.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from collections import OrderedDict
+import os
+import os.path
+import threading
+
+# Local library imports.
+from . import instrument
+from .data import build_db, data_version, getdata, import_corpus
+from .pools import load_pools
+
+__all__ = ['Corpus', 'EngineCache', 'get_engine_cache',
+           'DEFAULT_MAX_ENGINES']
+
+# The number of corpora whose name pools are held in memory at once, by
+# default.
+DEFAULT_MAX_ENGINES = 32
+
+def _signature(path):
+    '''Identify the current version of a database file.
+
+    A rebuilt or changed file gets a new signature (see also the getdata()
+    result cache, which works the same way). A missing file has none.
+
+    '''
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class EngineCache:
+    '''Name pools loaded from corpora, least recently used first out.
+
+    The pools for a corpus (with the plans, filter indices and other
+    structures cached alongside them) are its engine. Engines are
+    loaded when first needed, and reloaded if their database has since
+    been rebuilt or changed. When a load takes the cache over either of
+    its limits, the least recently used engines are evicted; generation
+    already under way finishes with the engine it started with, which
+    is freed once nothing refers to it.
+
+    '''
+    def __init__(self, max_engines=DEFAULT_MAX_ENGINES, max_bytes=None):
+        '''Create an empty cache.
+
+        Keyword arguments:
+            max_engines -- The maximum number of engines to hold.
+            max_bytes -- The maximum total size of the engines held, as
+                measured by NamePools.nbytes (which counts the pools'
+                compact data, but not the structures cached alongside
+                them). If omitted, only the number of engines is
+                limited. The engine most recently loaded is always held,
+                however large.
+
+        '''
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'reloads': 0,
+                       'evictions': 0}
+        self.set_limits(max_engines, max_bytes)
+
+    def set_limits(self, max_engines=DEFAULT_MAX_ENGINES, max_bytes=None):
+        '''Change the cache's limits, evicting engines to meet them.'''
+        if max_engines < 1:
+            raise ValueError('engine limit must be positive')
+        if max_bytes is not None and max_bytes < 1:
+            raise ValueError('memory limit must be positive')
+        with self._lock:
+            self.max_engines, self.max_bytes = max_engines, max_bytes
+            self._evict()
+
+    def _evict(self):
+        '''Evict the least recently used engines until within the limits.'''
+        total = (None if self.max_bytes is None else
+                 sum(pools.nbytes for _, pools in self._engines.values()))
+        while len(self._engines) > 1 and (
+                len(self._engines) > self.max_engines or
+                (total is not None and total > self.max_bytes)):
+            _, (_, pools) = self._engines.popitem(last=False)
+            if total is not None:
+                total -= pools.nbytes
+            self._stats['evictions'] += 1
+
+    def get(self, corpus):
+        '''Get the (cached) name pools for a corpus.'''
+        path = corpus.path
+        signature = _signature(path)
+        with self._lock:
+            entry = self._engines.get(path)
+            if entry is not None and entry[0] == signature:
+                self._engines.move_to_end(path)
+                self._stats['hits'] += 1
+                instrument.count('engine_cache_hits')
+                return entry[1]
+            self._stats['reloads' if entry is not None else 'misses'] += 1
+        instrument.count('engine_cache_misses')
+
+        # Load outside the lock, so other corpora can be served meanwhile.
+        with instrument.span('corpus.load'):
+            pools = load_pools(path)
+        if signature is None:
+            # The database was built by loading it.
+            signature = _signature(path)
+        with self._lock:
+            self._engines[path] = (signature, pools)
+            self._engines.move_to_end(path)
+            self._evict()
+        return pools
+
+    def evict(self, corpus):
+        '''Discard the engine for a corpus (or a database path), if held.'''
+        path = corpus.path if isinstance(corpus, Corpus) else corpus
+        with self._lock:
+            self._engines.pop(os.path.abspath(path), None)
+
+    def clear(self):
+        '''Discard every engine.'''
+        with self._lock:
+            self._engines.clear()
+
+    def __len__(self):
+        return len(self._engines)
+
+    def __contains__(self, corpus):
+        path = corpus.path if isinstance(corpus, Corpus) else corpus
+        return os.path.abspath(path) in self._engines
+
+    def stats(self):
+        '''Get statistics on the cache.
+
+        Returns:
+            A dictionary of the number of cache hits, misses (first
+            loads), reloads (of changed databases) and evictions (to stay
+            within the limits), the number of engines held, their total
+            size in bytes (see __init__()), and the limits.
+
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['engines'] = len(self._engines)
+            stats['bytes'] = sum(pools.nbytes
+                                 for _, pools in self._engines.values())
+        stats['max_engines'] = self.max_engines
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+# The cache shared by corpora that aren't given one.
+_engine_cache = EngineCache()
+
+def get_engine_cache():
+    '''Get the engine cache shared by default by every corpus.'''
+    return _engine_cache
+
+class Corpus:
+    '''A handle on a database of names, for generating names from it.
+
+    A corpus can be passed as the pools argument of generate(),
+    generate_many(), name_for_key() and the other functions that accept
+    one, in place of a NamePools. Handles are cheap to create: they hold
+    only the database's path, and the name pools are loaded when first
+    needed and held in an engine cache (see EngineCache), which handles
+    on the same database share.
+
+    '''
+    __slots__ = ('path', 'cache')
+
+    def __init__(self, path, cache=None):
+        '''Create a handle.
+
+        Arguments:
+            path -- The database file. If it doesn't exist, it is built
+                from the bundled CSV files when first used (as getdata()
+                does). Use import_names() to add names to it.
+            cache -- The EngineCache to hold the pools in. If omitted,
+                the shared cache (see get_engine_cache()) is used.
+
+        '''
+        self.path = os.path.abspath(path)
+        self.cache = cache
+
+    def pools(self):
+        '''Get the name pools for this corpus, loading them if need be.'''
+        cache = _engine_cache if self.cache is None else self.cache
+        return cache.get(self)
+
+    def version(self):
+        '''Get the version number of the database (see data_version()).'''
+        return data_version(self.path)
+
+    def build(self, verbosity=0):
+        '''(Re)build the database from the bundled CSV files.'''
+        build_db(dbfilename=self.path, verbosity=verbosity)
+
+    def import_names(self, path_or_iterable, source, **kwargs):
+        '''Add names to the database (see import_corpus()).'''
+        return import_corpus(path_or_iterable, source, dbfilename=self.path,
+                             **kwargs)
+
+    def getdata(self, source, **kwargs):
+        '''Fetch data from the database (see getdata()).'''
+        return getdata(source, dbfilename=self.path, **kwargs)
+
+    def __eq__(self, other):
+        if not isinstance(other, Corpus):
+            return NotImplemented
+        return self.path == other.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return 'Corpus({!r})'.format(self.path)
@@ -19,13 +19,24 @@
 # along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
 
 # Standard library imports.
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import csv
+from functools import lru_cache
+import os
 import os.path
+import shutil
 import sqlite3
+import sys
+import tempfile
+import time
+
+# Local library imports.
+from . import instrument
 
 __all__ = ['MASCULINE', 'FEMININE', 'NEUTER', 'GENDERS', 'DEFAULT_DBFILE',
-           'DATA_COLUMNS', 'build_db', 'getdata']
+           'DATA_COLUMNS', 'build_db', 'data_version', 'getdata',
+           'import_corpus', 'validate_row', 'enable_cache', 'disable_cache',
+           'clear_cache', 'cache_stats']
 
 # Symbolic constants for genders, and a list of nationalities for validation.
 MASCULINE, FEMININE, NEUTER = GENDERS = 'MFN'
@@ -60,20 +71,117 @@ DATA_COLUMNS = {'personal': ('name', 'romanisation', 'gender', 'nationality'),
                                 'nationality')
                 }
 # Shorthand to construct a namedtuple class suitable for each data source.
-nt_for = lambda source: namedtuple('{}_tuple'.format(source),
-                                   DATA_COLUMNS[source])
+# Each class is constructed once and then reused.
+nt_for = lru_cache(maxsize=None)(
+    lambda source: namedtuple('{}_tuple'.format(source), DATA_COLUMNS[source]))
+
+def csvdata(source, filename=None):
+    '''Read in data from the named CSV source file.
+
+    Records are read one at a time as the result is iterated over, and
+    the file is closed once they are exhausted.
 
-def csvdata(source):
-    '''Read in data from the named CSV source file.'''
-    filename = os.path.join(DATA_DIR, source + '.csv')
+    Keyword arguments:
+        source -- The data source the file is for (e.g. 'personal').
+        filename -- The CSV file to read. If omitted, the bundled file
+            for the data source is read.
+
+    '''
+    if filename is None:
+        filename = os.path.join(DATA_DIR, source + '.csv')
     nt = nt_for(source)
 
-    return map(nt._make, csv.reader(open(filename, encoding='utf-8',
-                                         newline='')))
+    with open(filename, encoding='utf-8', newline='') as f:
+        yield from map(nt._make, csv.reader(f))
+
+# The result cache for getdata(): an LRU mapping of normalised queries to
+# 2-tuples of the time cached and the records found. It is disabled (None)
+# unless enable_cache() is called.
+_cache = None
+_cache_limit = 256
+_cache_ttl = None
+_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+def enable_cache(maxsize=256, ttl=None):
+    '''Start caching the results of non-randomised getdata() queries.
+
+    Cached results are discarded when the database they came from is
+    rebuilt or changed (by this process or any other).
+
+    Keyword arguments:
+        maxsize -- The maximum number of query results to hold. The
+            least recently used are discarded first.
+        ttl -- The number of seconds for which a result stays valid. If
+            omitted, results stay valid until evicted.
+
+    '''
+    global _cache, _cache_limit, _cache_ttl
+    if maxsize < 1:
+        raise ValueError('cache size must be positive')
+    _cache_limit, _cache_ttl = maxsize, ttl
+    if _cache is None:
+        _cache = OrderedDict()
+    while len(_cache) > _cache_limit:
+        _cache.popitem(last=False)
+        _cache_stats['evictions'] += 1
+
+def disable_cache():
+    '''Stop caching getdata() results, and discard any cached.'''
+    global _cache
+    _cache = None
+
+def clear_cache(dbfilename=None):
+    '''Discard cached getdata() results.
+
+    Keyword arguments:
+        dbfilename -- If given, only results from this database are
+            discarded.
+
+    '''
+    if _cache is None:
+        return
+    if dbfilename is None:
+        _cache.clear()
+    else:
+        dbfilename = os.path.abspath(dbfilename)
+        for key in [key for key in _cache if key[0] == dbfilename]:
+            del _cache[key]
+
+def cache_stats():
+    '''Get statistics on the getdata() result cache.
+
+    Returns:
+        A dictionary of the number of cache hits, misses, evictions (to
+        stay within the size limit) and expirations (past the time
+        limit), the hit rate (from 0 to 1, or None before any queries),
+        the current number of entries and whether caching is enabled.
+
+    '''
+    stats = dict(_cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+    stats['size'] = 0 if _cache is None else len(_cache)
+    stats['enabled'] = _cache is not None
+    return stats
+
+# The number of rows fetched at a time by streaming queries.
+STREAM_CHUNK_SIZE = 1000
 
 def getdata(source, dbfilename=DEFAULT_DBFILE, randomise=False, limit=None,
-         verbosity=0, **kwargs):
-    '''Fetch data from the SQLite database.'''
+         verbosity=0, stream=False, chunk_size=STREAM_CHUNK_SIZE, **kwargs):
+    '''Fetch data from the SQLite database.
+
+    Results of queries that are not randomised are served from the
+    result cache, if enabled (see enable_cache()).
+
+    With stream=True, the query is not run until the first record is
+    requested, and records are then fetched chunk_size rows at a time
+    from a live cursor, so memory use stays flat however many records
+    match. The connection stays open until the records are exhausted or
+    the returned generator is closed (or garbage collected). Streamed
+    results are never cached.
+
+    '''
     nt = nt_for(source)
 
     query, qparms = ['SELECT * FROM "{}"'.format(source)], []
@@ -86,7 +194,8 @@ def getdata(source, dbfilename=DEFAULT_DBFILE, randomise=False, limit=None,
     if len(kwargs) > 0:
         query.append('WHERE')
         where = []
-        for kw, val in kwargs.items():
+        # Sort the criteria, so that equivalent queries are written alike.
+        for kw, val in sorted(kwargs.items()):
             # Are there multiple values specified?
             val_is_multipart = not isinstance(val, str) # Strings don't count.
             if val_is_multipart: # Actually only a maybe at this point.
@@ -149,24 +258,376 @@ def getdata(source, dbfilename=DEFAULT_DBFILE, randomise=False, limit=None,
     # Pass it to the database.
     if not os.path.isfile(dbfilename):
         build_db(dbfilename=dbfilename, verbosity=verbosity)
-    conn = sqlite3.connect(dbfilename)
+
+    if stream:
+        return _stream(nt, dbfilename, query_string, qparms, chunk_size)
+
+    # Use a cached result, if there is one.
+    cache_key = None
+    if _cache is not None and not randomise:
+        # The database file's identity and modification time are part of
+        # the key, so results from a replaced or changed database are never
+        # used.
+        stat = os.stat(dbfilename)
+        cache_key = (os.path.abspath(dbfilename), stat.st_ino,
+                     stat.st_mtime_ns, stat.st_size, query_string,
+                     tuple(qparms))
+        try:
+            cached_at, records = _cache[cache_key]
+        except KeyError:
+            pass
+        else:
+            if _cache_ttl is None or time.monotonic() - cached_at < _cache_ttl:
+                _cache.move_to_end(cache_key)
+                _cache_stats['hits'] += 1
+                instrument.count('getdata_cache_hits')
+                return iter(records)
+            del _cache[cache_key]
+            _cache_stats['expirations'] += 1
+        _cache_stats['misses'] += 1
+        instrument.count('getdata_cache_misses')
+
+    with instrument.span('db.connect'):
+        conn = sqlite3.connect(dbfilename)
     try:
         cur = conn.cursor()
-        cur.execute(query_string, qparms)
-        results = map(nt._make, cur.fetchall())
+        with instrument.span('db.query'):
+            cur.execute(query_string, qparms)
+        instrument.count('queries')
+        with instrument.span('db.fetch'):
+            rows = cur.fetchall()
+        instrument.count('rows_fetched', len(rows))
+        results = map(nt._make, rows)
     finally:
         # Do not commit (as no changes ought to have been made). Just close it.
         conn.close()
+
+    if cache_key is not None:
+        records = tuple(results)
+        _cache[cache_key] = (time.monotonic(), records)
+        if len(_cache) > _cache_limit:
+            _cache.popitem(last=False)
+            _cache_stats['evictions'] += 1
+        results = iter(records)
     return results
 
+def _stream(nt, dbfilename, query_string, qparms, chunk_size):
+    '''Yield the results of a query a chunk at a time.'''
+    with instrument.span('db.connect'):
+        conn = sqlite3.connect(dbfilename)
+    try:
+        cur = conn.cursor()
+        with instrument.span('db.query'):
+            cur.execute(query_string, qparms)
+        instrument.count('queries')
+        while True:
+            with instrument.span('db.fetch'):
+                rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            instrument.count('rows_fetched', len(rows))
+            yield from map(nt._make, rows)
+    finally:
+        conn.close()
+
+# The order in which data sources must be imported. Patro-/matronymics refer
+# to personal names, so those must exist first.
+IMPORT_ORDER = ('personal', 'additional', 'family', 'pmatronymic')
+IMPORT_DESCRIPTIONS = {'personal': 'Personal names',
+                       'additional': 'Additional names',
+                       'family': 'Family names',
+                       'pmatronymic': 'Patro-/matronymics'}
+
+# The number of records inserted per transaction when importing.
+BUILD_CHUNK_SIZE = 10000
+
+# SQL to insert one record from each data source. Parameters are in the order
+# of DATA_COLUMNS, except that family name counterparts are left out (they
+# are matched up once all names are inserted, since a counterpart may come
+# later in the input) and the name a patro-/matronymic derives from is moved
+# to the end. Patro-/matronymics take the ID of the first personal name
+# matching that name; nothing is inserted if there is none.
+INSERT_SQL = {'personal': ('INSERT INTO PersonalNames'
+                           ' (Name, Romanisation, Gender, Nationality)'
+                           ' VALUES (?, ?, ?, ?)'),
+              'additional': ('INSERT INTO AdditionalNames'
+                             ' (Name, Romanisation, Gender, Nationality)'
+                             ' VALUES (?, ?, ?, ?)'),
+              'family': ('INSERT INTO FamilyNames'
+                         ' (Name, Romanisation, Gender, Nationality)'
+                         ' VALUES (?, ?, ?, ?)'),
+              'pmatronymic': ('INSERT INTO PMatronymics'
+                              ' (Name, Romanisation, FromPersonalNameID,'
+                              '  Gender, Nationality)'
+                              ' SELECT ?, ?, PersonalNameID, ?, ?'
+                              '  FROM PersonalNames'
+                              '  WHERE Name = ?'
+                              '  ORDER BY PersonalNameID LIMIT 1')}
+INSERT_FIELDS = {'personal': ('name', 'romanisation', 'gender',
+                              'nationality'),
+                 'additional': ('name', 'romanisation', 'gender',
+                                'nationality'),
+                 'family': ('name', 'romanisation', 'gender', 'nationality'),
+                 'pmatronymic': ('name', 'romanisation', 'gender',
+                                 'nationality', 'from_')}
+
+def validate_row(source, row):
+    '''Check one row of input data for a data source.
+
+    Returns:
+        The row as a namedtuple (see nt_for()).
+    Raises:
+        ValueError -- If the row is malformed.
+
+    '''
+    columns = DATA_COLUMNS[source]
+    if len(row) != len(columns):
+        raise ValueError('expected {} fields, found {}'.format(len(columns),
+                                                              len(row)))
+    record = nt_for(source)._make(row)
+    if record.name == '':
+        raise ValueError('empty name')
+    if record.gender not in GENDERS:
+        raise ValueError("unknown gender '{}'".format(record.gender))
+    if record.nationality == '':
+        raise ValueError('empty nationality')
+    if source == 'pmatronymic' and record.from_ == '':
+        raise ValueError('empty source name')
+    return record
+
+def _chunks(iterable, size):
+    '''Split an iterable into lists of at most size items.'''
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _create_indices(cur):
+    '''Index the columns that imports look names up by.'''
+    cur.execute('CREATE INDEX IF NOT EXISTS PersonalNamesByName'
+                ' ON PersonalNames (Name)')
+    cur.execute('CREATE INDEX IF NOT EXISTS FamilyNamesByName'
+                ' ON FamilyNames (Name, Nationality)')
+
+def _import_rows(cur, source, rows, chunk_size, on_error='raise',
+                 progress=None, commit=None):
+    '''Validate and insert rows into the table for a data source.
+
+    Arguments:
+        cur -- A cursor on the database.
+        source -- The data source (e.g. 'personal').
+        rows -- An iterable of rows, each a sequence of fields in the
+            order of DATA_COLUMNS[source].
+        chunk_size -- The number of rows to insert at once.
+        on_error -- 'raise' to stop at the first invalid row, or 'skip'
+            to skip (and report) invalid rows.
+        progress -- A function to call after each chunk, with the data
+            source and the number of rows read so far.
+        commit -- A function to call after each chunk, to commit it.
+    Returns:
+        A 2-tuple of the numbers of rows inserted and rows skipped.
+
+    '''
+    fields = INSERT_FIELDS[source]
+    inserted = skipped = read = 0
+
+    def valid_rows(rows):
+        nonlocal skipped
+        for line_num, row in enumerate(rows, start=1):
+            try:
+                yield validate_row(source, row)
+            except ValueError as ve:
+                if on_error != 'skip':
+                    raise ValueError('{} record {}: {}'.format(source,
+                                                               line_num,
+                                                               ve.args[0]))
+                print('WARNING: skipping {} record {}: '
+                      '{}'.format(source, line_num, ve.args[0]),
+                      file=sys.stderr)
+                skipped += 1
+
+    if source == 'family':
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS PendingCounterparts'
+                    ' (Name TEXT, Nationality TEXT, Counterpart TEXT)')
+        cur.execute('CREATE INDEX IF NOT EXISTS temp.PendingCounterpartsByName'
+                    ' ON PendingCounterparts (Name, Nationality)')
+
+    for chunk in _chunks(valid_rows(rows), chunk_size):
+        read += len(chunk)
+        before = cur.connection.total_changes
+        cur.executemany(INSERT_SQL[source],
+                        ([getattr(record, field) for field in fields]
+                         for record in chunk))
+        chunk_inserted = cur.connection.total_changes - before
+        if chunk_inserted < len(chunk):
+            # Patro-/matronymics whose source name wasn't found.
+            print("WARNING: skipping {} {} record(s) whose source name "
+                  "can't be found".format(len(chunk) - chunk_inserted,
+                                          source),
+                  file=sys.stderr)
+            skipped += len(chunk) - chunk_inserted
+        inserted += chunk_inserted
+
+        if source == 'family':
+            cur.executemany('INSERT INTO PendingCounterparts'
+                            ' VALUES (?, ?, ?)',
+                            ((record.name, record.nationality,
+                              record.counterpart)
+                             for record in chunk
+                             if record.counterpart != ''))
+        if commit is not None:
+            commit()
+        if progress is not None:
+            progress(source, read)
+
+    if source == 'family':
+        # Match up gender counterparts, within the same nationality, in one
+        # pass.
+        cur.execute('UPDATE FamilyNames'
+                    ' SET CounterpartID ='
+                    '  (SELECT MIN(cn.FamilyNameID)'
+                    '   FROM PendingCounterparts p JOIN FamilyNames cn'
+                    '    ON cn.Name = p.Counterpart'
+                    '    AND cn.Nationality = p.Nationality'
+                    '   WHERE p.Name = FamilyNames.Name'
+                    '   AND p.Nationality = FamilyNames.Nationality)'
+                    ' WHERE CounterpartID IS NULL'
+                    ' AND (Name, Nationality) IN'
+                    '  (SELECT Name, Nationality FROM PendingCounterparts)')
+        cur.execute('DROP TABLE PendingCounterparts')
+        if commit is not None:
+            commit()
+    return inserted, skipped
+
+def data_version(dbfilename=DEFAULT_DBFILE):
+    '''Get the version number of a database (0 if it doesn't exist).
+
+    The version is increased by one every time build_db() rebuilds the
+    database.
+
+    '''
+    if not os.path.isfile(dbfilename):
+        return 0
+    conn = sqlite3.connect(dbfilename)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        conn.close()
+
 def build_db(dbfilename=DEFAULT_DBFILE, verbosity=0):
-    '''(Re)build the SQLite database from the CSV files.'''
+    '''(Re)build the SQLite database from the CSV files.
+
+    The new database is written to a temporary file, which then replaces
+    the old database in one atomic step. Readers that are already
+    connected to the old database keep a consistent view of it until
+    they disconnect, and never have to wait for the rebuild.
+
+    '''
     if verbosity:
         print("(Re)building database in file '{}'...".format(dbfilename))
+    version = data_version(dbfilename) + 1
+    # Create the temporary file alongside the database, so that it can be
+    # renamed over it (renaming across file systems isn't atomic).
+    fd, tmpfilename = tempfile.mkstemp(suffix='.tmp',
+                                       prefix=os.path.basename(dbfilename),
+                                       dir=os.path.dirname(dbfilename) or '.')
+    os.close(fd)
+    try:
+        _build_db(tmpfilename, version, verbosity)
+        # Temporary files are private to their owner; give the new database
+        # the same permissions as the old one instead.
+        if os.path.isfile(dbfilename):
+            shutil.copymode(dbfilename, tmpfilename)
+        else:
+            os.chmod(tmpfilename, 0o644)
+        os.replace(tmpfilename, dbfilename)
+    except BaseException:
+        os.remove(tmpfilename)
+        raise
+    clear_cache(dbfilename)
+    if verbosity > 1:
+        print('\tDatabase version {} swapped in'.format(version))
+
+def import_corpus(path_or_iterable, source, dbfilename=DEFAULT_DBFILE,
+                  chunk_size=BUILD_CHUNK_SIZE, progress=None,
+                  on_error='raise', verbosity=0):
+    '''Add names from an extra corpus to the database.
+
+    Records are read, validated and inserted a chunk at a time, each
+    chunk in its own transaction, so inputs of any size are imported in
+    constant memory. The bundled data is left in place (the database is
+    built first if it doesn't exist), and the database version is
+    increased so that refresh_pools() picks up the new names.
+
+    Arguments:
+        path_or_iterable -- The name of a CSV file, or an iterable of
+            rows, in the format of the bundled file for the data source.
+        source -- The data source the records belong to (e.g.
+            'personal').
+    Keyword arguments:
+        dbfilename -- The database to add the names to.
+        chunk_size -- The number of records to insert per transaction.
+        progress -- A function to call after each chunk, with the data
+            source and the number of records read so far.
+        on_error -- 'raise' to stop at the first invalid record (earlier
+            chunks stay imported), or 'skip' to skip invalid records
+            with a warning.
+        verbosity -- The level of detail to print.
+    Returns:
+        A 2-tuple of the numbers of records imported and skipped.
+
+    '''
+    if source not in DATA_COLUMNS:
+        raise ValueError("unknown data source '{}'".format(source))
+    if on_error not in ('raise', 'skip'):
+        raise ValueError("unknown error handling '{}'".format(on_error))
+    if chunk_size < 1:
+        raise ValueError('chunk size must be positive')
+    if isinstance(path_or_iterable, (str, bytes, os.PathLike)):
+        rows = csvdata(source, path_or_iterable)
+    else:
+        rows = path_or_iterable
+
+    if not os.path.isfile(dbfilename):
+        build_db(dbfilename, verbosity)
+    if verbosity:
+        print("Importing {} names into '{}'...".format(source, dbfilename))
+
+    conn = sqlite3.connect(dbfilename)
+    try:
+        cur = conn.cursor()
+        _create_indices(cur)
+        try:
+            with instrument.span('db.import'):
+                imported, skipped = _import_rows(cur, source, rows,
+                                                 chunk_size,
+                                                 on_error=on_error,
+                                                 progress=progress,
+                                                 commit=conn.commit)
+        finally:
+            # Whatever was committed is now part of the data.
+            conn.rollback()
+            version = cur.execute('PRAGMA user_version').fetchone()[0] + 1
+            cur.execute('PRAGMA user_version = {:d}'.format(version))
+            conn.commit()
+    finally:
+        conn.close()
+        clear_cache(dbfilename)
+
+    if verbosity:
+        print('\t{} records imported, {} skipped'.format(imported, skipped))
+    return imported, skipped
+
+def _build_db(dbfilename, version, verbosity):
+    '''Build the SQLite database from the CSV files, in place.'''
     # Connect to the database file.
     conn = sqlite3.connect(dbfilename)
     try:
-        with conn:
+        with conn, instrument.span('db.build'):
             cur = conn.cursor()
             # Remove views on tables.
             cur.execute('DROP VIEW IF EXISTS personal')
@@ -222,66 +683,13 @@ def build_db(dbfilename=DEFAULT_DBFILE, verbosity=0):
                 print('\tTables (re)built')
 
             # Read data files and populate tables.
-            cur.executemany('INSERT INTO PersonalNames'
-                            ' (Name, Romanisation, Gender, Nationality)'
-                            ' VALUES (?, ?, ?, ?)', csvdata('personal'))
-            # Only detail individual steps if extra verbosity was requested.
-            if verbosity > 1:
-                print('\tPersonal names inserted')
-
-            cur.executemany('INSERT INTO AdditionalNames'
-                            ' (Name, Romanisation, Gender, Nationality)'
-                            ' VALUES (?, ?, ?, ?)', csvdata('additional'))
-            # Only detail individual steps if extra verbosity was requested.
-            if verbosity > 1:
-                print('\tAdditional names inserted')
-
-            for record in csvdata('family'):
-                cur.execute('INSERT INTO FamilyNames'
-                            ' (Name, Romanisation, Gender, Nationality)'
-                            ' VALUES (?, ?, ?, ?)', (record.name,
-                                                     record.romanisation,
-                                                     record.gender,
-                                                     record.nationality))
-            # Only detail individual steps if extra verbosity was requested.
-            if verbosity > 1:
-                print('\tFamily names inserted')
-            for record in csvdata('family'):
-                if record.counterpart != '':
-                    cur.execute('SELECT FamilyNameID'
-                                ' FROM FamilyNames'
-                                ' WHERE Name = ?', (record.name,))
-                    this_id = cur.fetchone()[0]
-                    cur.execute('SELECT FamilyNameID'
-                                ' FROM FamilyNames'
-                                ' WHERE Name = ?', (record.counterpart,))
-                    that_id = cur.fetchone()[0]
-                    cur.execute('UPDATE FamilyNames'
-                                ' SET CounterpartID = ?'
-                                ' WHERE FamilyNameID = ?', (that_id, this_id))
-            # Only detail individual steps if extra verbosity was requested.
-            if verbosity > 1:
-                print('\tFamily name gender counterparts matched up')
-
-            for record in csvdata('pmatronymic'):
-                cur.execute('SELECT PersonalNameID'
-                            ' FROM PersonalNames'
-                            ' WHERE Name = ?', (record.from_,))
-                try:
-                    from_id = cur.fetchone()[0]
-                except TypeError:
-                    print("Can't find name '{}'!".format(record.from_))
-                cur.execute('INSERT INTO PMatronymics'
-                            ' (Name, Romanisation, FromPersonalNameID,'
-                            '  Gender, Nationality)'
-                            ' VALUES (?, ?, ?, ?, ?)', (record.name,
-                                                        record.romanisation,
-                                                        from_id,
-                                                        record.gender,
-                                                        record.nationality))
-            # Only detail individual steps if extra verbosity was requested.
-            if verbosity > 1:
-                print('\tPatro-/matronymics inserted')
+            for source in IMPORT_ORDER:
+                _import_rows(cur, source, csvdata(source), BUILD_CHUNK_SIZE)
+                # Only detail individual steps if extra verbosity was
+                # requested.
+                if verbosity > 1:
+                    print('\t{} inserted'.format(IMPORT_DESCRIPTIONS[source]))
+            _create_indices(cur)
 
             cur.execute('CREATE VIEW personal AS'
                         ' SELECT pn.Name as name'
@@ -317,5 +725,7 @@ def build_db(dbfilename=DEFAULT_DBFILE, verbosity=0):
             # Only detail individual steps if extra verbosity was requested.
             if verbosity > 1:
                 print('\tViews created')
+
+            cur.execute('PRAGMA user_version = {:d}'.format(version))
     finally:
         conn.close()
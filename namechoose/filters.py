@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+'''Restrict generated names to those meeting given constraints.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from array import array
+from bisect import bisect_right
+import unicodedata
+
+# Local library imports.
+from . import instrument
+from .pools import UINT32
+
+__all__ = ['NameFilter', 'FilterIndex', 'display_form', 'fold',
+           'name_scripts', 'get_filter_index']
+
+# Script names that don't follow from the first word of a character's
+# Unicode name.
+_SCRIPT_ALIASES = {'CJK': 'Han'}
+
+def fold(s):
+    '''Normalise a string for matching.
+
+    The string is case-folded and decomposed, and combining marks are
+    dropped, so that (for example) 'KENTARO' matches 'Kentarō'. Both
+    constraints and reverse lookups (see namechoose.reverse) compare
+    names this way.
+
+    '''
+    return ''.join(c for c in unicodedata.normalize('NFKD', s.casefold())
+                   if not unicodedata.combining(c))
+
+def display_form(pools, row):
+    '''Get the form of a record's name that constraints are checked on.
+
+    This is the romanisation from the data, or the name itself if it is
+    already in Latin script.
+
+    '''
+    return pools.romanisation(row) or pools.name(row)
+
+def name_scripts(name):
+    '''Get the set of scripts (e.g. 'Latin', 'Cyrillic') a name uses.
+
+    Only letters count; modifier letters (such as the apostrophe-like
+    letter in some Ukrainian names) are ignored.
+
+    '''
+    scripts = set()
+    for c in name:
+        if unicodedata.category(c) in ('Lu', 'Ll', 'Lt', 'Lo'):
+            script = unicodedata.name(c, 'UNKNOWN').split()[0]
+            scripts.add(_SCRIPT_ALIASES.get(script, script.title()))
+    return scripts
+
+class NameFilter:
+    '''A set of constraints on the parts of generated names.
+
+    Instances are immutable and hashable, so the subsets of names they
+    select (and the plans that use them) can be cached.
+
+    '''
+    __slots__ = ('initials', 'max_length', 'scripts', 'exclude', 'parts')
+
+    def __init__(self, initials=None, max_length=None, scripts=None,
+                 exclude=(), parts=None):
+        '''Define the constraints.
+
+        Initials, lengths and deny-list entries are compared with each
+        name's display form (see display_form()), ignoring case and
+        diacritics.
+
+        Keyword arguments:
+            initials -- The letters that names may begin with (e.g.
+                'AEK'). If omitted, any letter is allowed.
+            max_length -- The maximum length of each name part, in
+                characters.
+            scripts -- The scripts that names may be written in (e.g.
+                ('Latin',) for names needing no romanisation). If
+                omitted, any script is allowed.
+            exclude -- Names that must not be chosen. A name is
+                excluded if either its display form or its native form
+                is listed.
+            parts -- The name parts (labels from FORMATS, such as
+                'personal' or 'patronym') the constraints apply to. If
+                omitted, they apply to every part.
+
+        '''
+        self.initials = (None if initials is None else
+                         frozenset(fold(c)[:1] for c in initials))
+        if max_length is not None and max_length < 1:
+            raise ValueError('maximum length must be positive')
+        self.max_length = max_length
+        self.scripts = None if scripts is None else frozenset(scripts)
+        self.exclude = frozenset(fold(name) for name in exclude)
+        self.parts = None if parts is None else frozenset(parts)
+
+    def _key(self):
+        return (self.initials, self.max_length, self.scripts, self.exclude,
+                self.parts)
+
+    def __eq__(self, other):
+        if not isinstance(other, NameFilter):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def applies_to(self, part):
+        '''Check whether the constraints apply to a name part.'''
+        return self.parts is None or part in self.parts
+
+    def __repr__(self):
+        return ('NameFilter(initials={0.initials!r}, '
+                'max_length={0.max_length!r}, scripts={0.scripts!r}, '
+                'exclude={0.exclude!r}, parts={0.parts!r})'.format(self))
+
+class FilterIndex:
+    '''Per-pool indices answering constraint queries without a scan.
+
+    For each pool, its records are grouped by initial and by script, and
+    listed in order of display length, so that a bisection finds those
+    short enough. Every record's initial, length and scripts are also
+    kept, for checking candidates against the remaining constraints.
+
+    '''
+    def __init__(self, pools):
+        '''Build the index.'''
+        self.pools = pools
+        self._subsets = {}
+
+        with instrument.span('filter.build'):
+            # Per record: folded initial, display length and a bit mask of
+            # scripts (bit n is set for self.scripts[n]).
+            self._initial = []
+            self._length = array(UINT32)
+            self._script_mask = array(UINT32)
+            self.scripts = []
+            script_bits = {}
+            # Folded name (in either form) -> record numbers.
+            self._by_name = {}
+            for row in range(len(pools)):
+                display = display_form(pools, row)
+                folded = fold(display)
+                self._initial.append(folded[:1])
+                self._length.append(len(display))
+                mask = 0
+                for script in name_scripts(pools.name(row)):
+                    if script not in script_bits:
+                        script_bits[script] = 1 << len(self.scripts)
+                        self.scripts.append(script)
+                    mask |= script_bits[script]
+                self._script_mask.append(mask)
+                for form in {folded, fold(pools.name(row))}:
+                    self._by_name.setdefault(form, []).append(row)
+            self._script_bits = script_bits
+
+            # Per pool: records by initial, records by script mask, and
+            # records sorted by length alongside their lengths.
+            self._by_initial, self._by_script, self._by_length = {}, {}, {}
+            for key in pools.keys():
+                by_initial, by_script = {}, {}
+                for row in pools.pool(*key):
+                    by_initial.setdefault(self._initial[row],
+                                          array(UINT32)).append(row)
+                    by_script.setdefault(self._script_mask[row],
+                                         array(UINT32)).append(row)
+                ordered = array(UINT32, sorted(pools.pool(*key),
+                                            key=self._length.__getitem__))
+                self._by_initial[key] = by_initial
+                self._by_script[key] = by_script
+                self._by_length[key] = (ordered,
+                                        array(UINT32, (self._length[row]
+                                                    for row in ordered)))
+
+    def subset(self, source, nationality, gender, constraints):
+        '''Get the records of a pool that meet some constraints.
+
+        Arguments:
+            source, nationality, gender -- The pool's key.
+            constraints -- A NameFilter.
+        Returns:
+            An array of record numbers, in pool order. It may be empty.
+
+        '''
+        key = (source, nationality, gender)
+        try:
+            return self._subsets[key, constraints]
+        except KeyError:
+            pass
+
+        with instrument.span('filter.subset'):
+            # Each index yields the candidates for one constraint; start
+            # from the smallest, and check the rest record by record.
+            candidates = []
+            if constraints.initials is not None:
+                by_initial = self._by_initial.get(key, {})
+                candidates.append([row for initial in constraints.initials
+                                   for row in by_initial.get(initial, ())])
+            allowed_mask = None
+            if constraints.scripts is not None:
+                allowed_mask = 0
+                for script in constraints.scripts:
+                    allowed_mask |= self._script_bits.get(script, 0)
+                candidates.append([row for mask, rows in
+                                   self._by_script.get(key, {}).items()
+                                   if mask & ~allowed_mask == 0
+                                   for row in rows])
+            if constraints.max_length is not None:
+                ordered, lengths = self._by_length.get(key, ((), ()))
+                candidates.append(ordered[:bisect_right(
+                    lengths, constraints.max_length)])
+            if not candidates:
+                candidates.append(self.pools.pool(*key))
+            rows = min(candidates, key=len)
+
+            excluded = set()
+            for name in constraints.exclude:
+                excluded.update(self._by_name.get(name, ()))
+            subset = array(UINT32, sorted(
+                row for row in rows if row not in excluded and
+                (constraints.initials is None or
+                 self._initial[row] in constraints.initials) and
+                (allowed_mask is None or
+                 self._script_mask[row] & ~allowed_mask == 0) and
+                (constraints.max_length is None or
+                 self._length[row] <= constraints.max_length)))
+        self._subsets[key, constraints] = subset
+        return subset
+
+def get_filter_index(pools):
+    '''Get the (cached) filter index for some name pools.'''
+    # Indices are cached with the pools they refer to (see NamePools).
+    try:
+        return pools.derived['filter_index']
+    except KeyError:
+        index = pools.derived['filter_index'] = FilterIndex(pools)
+        return index
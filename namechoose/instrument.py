@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+'''Timing and counting instrumentation for namechoose.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from collections import Counter
+import json
+import sys
+import time
+
+__all__ = ['enable', 'disable', 'is_enabled', 'reset', 'span', 'count',
+           'add_callback', 'remove_callback', 'stats', 'dump_json', 'report']
+
+# Instrumentation is off unless explicitly switched on. While it is off, span()
+# hands back a shared do-nothing context manager and count() returns at once,
+# so instrumented code pays for little more than a function call.
+_enabled = False
+
+# Accumulated measurements: span name -> [calls, total seconds, max seconds],
+# and counter name -> count.
+_spans = {}
+_counters = Counter()
+
+# Functions to be called as callback(span_name, elapsed_seconds) whenever a
+# span closes.
+_callbacks = []
+
+def enable(on=True):
+    '''Switch instrumentation on (or off, if on is false).'''
+    global _enabled
+    _enabled = bool(on)
+
+def disable():
+    '''Switch instrumentation off.'''
+    enable(False)
+
+def is_enabled():
+    '''Report whether instrumentation is currently switched on.'''
+    return _enabled
+
+def reset():
+    '''Discard all accumulated timings and counts.'''
+    _spans.clear()
+    _counters.clear()
+
+class _NullSpan:
+    '''A context manager that does nothing, used when disabled.'''
+    __slots__ = ()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    '''A context manager that times the code it encloses.'''
+    __slots__ = ('name', 'start')
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        try:
+            record = _spans[self.name]
+        except KeyError:
+            record = _spans[self.name] = [0, 0.0, 0.0]
+        record[0] += 1
+        record[1] += elapsed
+        if elapsed > record[2]:
+            record[2] = elapsed
+        for callback in _callbacks:
+            callback(self.name, elapsed)
+        return False
+
+def span(name):
+    '''Time a block of code under the given name.
+
+    Use as a context manager:
+
+        with span('db.query'):
+            cur.execute(query_string, qparms)
+
+    '''
+    return _Span(name) if _enabled else _NULL_SPAN
+
+def count(name, n=1):
+    '''Add n to the named counter.'''
+    if _enabled:
+        _counters[name] += n
+
+def add_callback(callback):
+    '''Register a function to be called whenever a span closes.
+
+    The function is called with two arguments: the span name and the
+    elapsed time in seconds.
+
+    '''
+    _callbacks.append(callback)
+
+def remove_callback(callback):
+    '''Unregister a function previously passed to add_callback().'''
+    _callbacks.remove(callback)
+
+def stats():
+    '''Return accumulated timings and counts as a dictionary.'''
+    return {'spans': {name: {'calls': calls,
+                             'total': total,
+                             'mean': total / calls,
+                             'max': longest}
+                      for name, (calls, total, longest) in _spans.items()},
+            'counters': dict(_counters)}
+
+def dump_json(fp=None, **kwargs):
+    '''Write the accumulated statistics as JSON.
+
+    Keyword arguments:
+        fp -- A writable file object. If omitted, the JSON text is
+            returned instead of being written.
+        Any other keyword arguments are passed on to the json module.
+
+    '''
+    kwargs.setdefault('indent', 2)
+    kwargs.setdefault('sort_keys', True)
+    if fp is None:
+        return json.dumps(stats(), **kwargs)
+    json.dump(stats(), fp, **kwargs)
+
+def report(file=None):
+    '''Print a human-readable summary of the accumulated statistics.'''
+    if file is None:
+        file = sys.stderr
+    print('{:<24} {:>8} {:>12} {:>12} {:>12}'.format('Span', 'Calls',
+                                                      'Total (ms)',
+                                                      'Mean (ms)',
+                                                      'Max (ms)'),
+          file=file)
+    for name, (calls, total, longest) in sorted(_spans.items()):
+        print('{:<24} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+                  name, calls, total * 1000, total * 1000 / calls,
+                  longest * 1000),
+              file=file)
+    if _counters:
+        print(file=file)
+        print('{:<24} {:>8}'.format('Counter', 'Value'), file=file)
+        for name, value in sorted(_counters.items()):
+            print('{:<24} {:>8}'.format(name, value), file=file)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+'''Derive names deterministically from keys, for pseudonymisation.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from bisect import bisect_right
+from hashlib import blake2b
+
+# Local library imports.
+from . import (instrument, NAME_PARTS, NATIONALITIES, MASCULINE, FEMININE,
+               FORMATS, get_plan, nat_lookup, resolve_pools)
+
+__all__ = ['name_for_key', 'names_for_keys', 'key_space']
+
+# The number of Feistel rounds used to permute keys in bijective mode.
+FEISTEL_ROUNDS = 4
+
+def _to_bytes(value):
+    '''Encode a key or salt for hashing.'''
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value)
+    return str(value).encode('utf-8')
+
+def _hash_key(salt):
+    '''Turn a salt into a BLAKE2 key (at most 64 bytes).'''
+    salt = _to_bytes(salt)
+    if len(salt) > 64:
+        salt = blake2b(salt).digest()
+    return salt
+
+def _nationality(nationality):
+    '''Check and normalise a nationality argument.'''
+    nationality = nat_lookup(nationality)
+    if nationality not in FORMATS:
+        raise ValueError("unknown nationality '{}'".format(nationality))
+    return nationality
+
+def name_for_key(key, nationality=None, gender=None, salt='', pools=None,
+                 romanisation=None, bijective=False):
+    '''Get the name that a key maps to.
+
+    The same key, salt, arguments and data always give the same name,
+    without storing anything. In the default (hashed) mode, the key and
+    salt are hashed, and the hash chooses the nationality and gender
+    (unless given), the format and the record for each name part.
+    Different keys may map to the same name.
+
+    In bijective mode, keys must be integers from 0 up to (but not
+    including) key_space(nationality, gender); each maps to a different
+    name of that nationality and gender. The salt chooses the order in
+    which keys are assigned names.
+
+    Arguments:
+        key -- The key: a string, bytes or an integer.
+    Keyword arguments:
+        nationality, gender -- Specify values for these two name
+            parameters. Both are required in bijective mode.
+        salt -- A secret string or bytes; different salts give
+            unrelated mappings.
+        pools -- A NamePools instance or a Corpus to draw names from.
+            If omitted, the pools from the default database are used.
+            Changing the data changes the mapping.
+        romanisation -- The identifier of a transliteration ruleset to
+            romanise names with, where it applies (see generate()).
+        bijective -- If true, map keys one-to-one onto names.
+    Returns:
+        A 5-tuple, as returned by generate().
+
+    '''
+    mapper = _mapper(pools, salt, romanisation)
+    if nationality is not None:
+        nationality = _nationality(nationality)
+    if bijective:
+        return mapper.bijective(key, nationality, gender)
+    return mapper.hashed(key, nationality, gender)
+
+def names_for_keys(keys, nationality=None, gender=None, salt='', pools=None,
+                   romanisation=None, bijective=False):
+    '''Get the names that many keys map to (see name_for_key()).
+
+    Returns:
+        An iterator over 5-tuples, one per key, in order.
+
+    '''
+    mapper = _mapper(pools, salt, romanisation)
+    if nationality is not None:
+        nationality = _nationality(nationality)
+    name_from = mapper.bijective if bijective else mapper.hashed
+    for key in keys:
+        yield name_from(key, nationality, gender)
+
+class _Mapper:
+    '''Maps keys to names for one set of pools, salt and romanisation.
+
+    Mappers are cheap to create: the text of every record's name and
+    romanisation, which they need in full, is decoded from the compact
+    string table once per pools (see _texts()) and shared by the
+    mappers for every salt.
+
+    '''
+    def __init__(self, pools, salt, romanisation):
+        self.pools = pools
+        self.salt = salt
+        self.name_ids = pools.name_ids
+        self.names, self.romanisations = _texts(pools, romanisation)
+
+    def plan(self, nationality, gender):
+        '''Get the generation plan for a nationality and gender.'''
+        return get_plan(nationality, gender, self.pools)
+
+    def assemble(self, chosen, gender, nationality, fmt):
+        '''Build the 5-tuple for the chosen records.'''
+        romanisations = self.romanisations
+        instrument.count('names_generated')
+        return ([self.names[n] for n in chosen],
+                [romanisations[n] for n in chosen if romanisations[n] != ''],
+                gender, nationality, fmt)
+
+    def hashed(self, key, nationality, gender):
+        '''Map a key to a name through its hash.'''
+        h = int.from_bytes(blake2b(_to_bytes(key), digest_size=16,
+                                   key=self.salt).digest(), 'little')
+        # Peel choices off the hash as digits in a mixed radix. 128 bits
+        # leave ample entropy for every choice, so the bias from taking
+        # remainders is negligible.
+        if nationality is None:
+            h, n = divmod(h, len(NATIONALITIES))
+            nationality = NATIONALITIES[n]
+        if gender is None:
+            h, g = divmod(h, 2)
+            gender = (MASCULINE, FEMININE)[g]
+        plan = self.plan(nationality, gender)
+        h, f = divmod(h, len(plan.formats))
+        fmt, steps = plan.formats[f]
+
+        name_ids = self.name_ids
+        chosen = []
+        for pool, avoid in steps:
+            h, i = divmod(h, len(pool))
+            n = pool[i]
+            if avoid:
+                # Step past names already used in the same role. The plan
+                # guarantees there are enough distinct names for this to
+                # finish.
+                while any(name_ids[n] == name_ids[chosen[j]] for j in avoid):
+                    i = (i + 1) % len(pool)
+                    n = pool[i]
+            chosen.append(n)
+        return self.assemble(chosen, gender, nationality, fmt)
+
+    def bijective(self, key, nationality, gender):
+        '''Map an integer key one-to-one onto a name.'''
+        if nationality is None or gender is None:
+            raise ValueError('bijective mode requires a nationality and '
+                             'gender')
+        space = _key_space(self.pools, nationality, gender)
+        if not isinstance(key, int) or not 0 <= key < space.size:
+            raise ValueError('bijective mode requires integer keys from 0 '
+                             'to {} for {} {} names'.format(space.size - 1,
+                                                           nationality,
+                                                           gender))
+        fmt, chosen = space.decode(_permute(key, space.size, self.salt))
+        return self.assemble(chosen, gender, nationality, fmt)
+
+def _texts(pools, romanisation):
+    '''Get the (cached) names and romanisations of every record.
+
+    The text is cached with the pools (see NamePools): the names, and
+    the romanisations by ruleset (None for those from the data). These
+    don't depend on the salt, and there are only as many romanisations
+    as rulesets.
+
+    '''
+    try:
+        names = pools.derived['names']
+    except KeyError:
+        names = pools.derived['names'] = list(pools.strings[n]
+                                              for n in pools.name_ids)
+    key = ('romanisations', romanisation)
+    try:
+        romanisations = pools.derived[key]
+    except KeyError:
+        romanisations = pools.derived[key] = []
+        for row in range(len(pools)):
+            romanised = (None if romanisation is None else
+                         pools.romanisation_by(row, romanisation))
+            if romanised is None:
+                romanised = pools.romanisation(row)
+            romanisations.append(romanised)
+    return names, romanisations
+
+def _mapper(pools, salt, romanisation):
+    '''Get a mapper for some pools, salt and romanisation.
+
+    Mappers aren't cached, so a service using many salts (one per
+    tenant, say) doesn't accumulate them.
+
+    '''
+    pools = resolve_pools(pools)
+    if romanisation is not None and not pools.has_romanisations(romanisation):
+        pools.precompute_romanisations([romanisation])
+    return _Mapper(pools, _hash_key(salt), romanisation)
+
+class _KeySpace:
+    '''Every distinct name of one nationality and gender, numbered.
+
+    Formats that draw the same data sources in the same order (such as
+    a patronym or a matronym after a personal name) would yield the same
+    names, so only the first of them is used. Within each format, every
+    name part is a digit: an index into the distinct names of its pool,
+    skipping those already used in the same role.
+
+    '''
+    def __init__(self, pools, nationality, gender):
+        plan = get_plan(nationality, gender, pools)
+        name_id = pools.name_id
+        # One record per distinct name, for each pool.
+        distinct = {}
+        seen_sources = set()
+        self.formats, self.offsets = [], []
+        size = 0
+        for fmt, steps in plan.formats:
+            sources = tuple(NAME_PARTS[part] for part in fmt)
+            if sources in seen_sources:
+                continue
+            seen_sources.add(sources)
+            digits = []
+            capacity = 1
+            for pool, avoid in steps:
+                try:
+                    reps = distinct[id(pool)][1]
+                except KeyError:
+                    first = {}
+                    for n in pool:
+                        first.setdefault(name_id(n), n)
+                    reps = sorted(first.values())
+                    # Keep the pool alive, so its ID isn't reused.
+                    distinct[id(pool)] = (pool, reps)
+                digits.append((reps, avoid, len(reps) - len(avoid)))
+                capacity *= len(reps) - len(avoid)
+            self.formats.append((fmt, digits))
+            self.offsets.append(size)
+            size += capacity
+        self.size = size
+
+    def decode(self, x):
+        '''Get the format and records numbered x.'''
+        f = bisect_right(self.offsets, x) - 1
+        x -= self.offsets[f]
+        fmt, digits = self.formats[f]
+        positions, chosen = [], []
+        for reps, avoid, radix in digits:
+            x, r = divmod(x, radix)
+            # Skip over the positions of names used in the same role.
+            for p in sorted(positions[j] for j in avoid):
+                if p <= r:
+                    r += 1
+            positions.append(r)
+            chosen.append(reps[r])
+        return fmt, chosen
+
+def _key_space(pools, nationality, gender):
+    '''Get the (cached) key space for a nationality and gender.'''
+    # Key spaces are cached with their pools (see NamePools).
+    key = ('key_space', nationality, gender)
+    try:
+        return pools.derived[key]
+    except KeyError:
+        space = pools.derived[key] = _KeySpace(pools, nationality, gender)
+        return space
+
+def key_space(nationality, gender, pools=None):
+    '''Get the number of keys that bijective mode can map to names.
+
+    This is the number of distinct names of the nationality and gender.
+
+    '''
+    pools = resolve_pools(pools)
+    return _key_space(pools, _nationality(nationality), gender).size
+
+def _permute(x, size, salt):
+    '''Shuffle the integers in range(size), as chosen by a salt.
+
+    A balanced Feistel network permutes a power-of-four range at least
+    as large; results outside the range are fed back in until one falls
+    inside it ("cycle walking"), which keeps the mapping one-to-one.
+
+    '''
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    while True:
+        left, right = x >> half, x & mask
+        for i in range(FEISTEL_ROUNDS):
+            f = int.from_bytes(blake2b(right.to_bytes(16, 'little') +
+                                       bytes((i,)), digest_size=16,
+                                       key=salt).digest(), 'little')
+            left, right = right, left ^ (f & mask)
+        x = (left << half) | right
+        if x < size:
+            return x
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+'''Measure the memory allocated by each phase of namechoose's work.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from contextlib import contextmanager
+import gc
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+# Local library imports.
+from . import generate, translit
+from .batch import generate_many
+from .data import build_db, DEFAULT_DBFILE
+from .pools import load_pools
+
+__all__ = ['MemoryProfiler', 'profile_memory', 'report', 'dump_json',
+           'DEFAULT_BATCH_SIZES']
+
+# The batch sizes whose peak memory is measured, by default.
+DEFAULT_BATCH_SIZES = (1, 100, 10000)
+
+# The number of allocation sites reported for each phase, by default.
+TOP_SITES = 10
+
+# Allocations that belong to the measuring, not to the code measured.
+_IGNORED = tuple(tracemalloc.Filter(False, filename) for filename in
+                 (tracemalloc.__file__, __file__, '<unknown>',
+                  '<frozen importlib._bootstrap>',
+                  '<frozen importlib._bootstrap_external>'))
+
+class MemoryProfiler:
+    '''Records the memory allocated by named phases of work.
+
+    Use as a context manager, which starts tracing allocations (unless
+    something else already has) and stops it again afterwards:
+
+        with MemoryProfiler() as profiler:
+            with profiler.phase('pool load'):
+                pools = load_pools()
+
+    Each phase's record (in the phases attribute, in the order the phases
+    ran) is a dictionary with these keys:
+        allocated -- The memory still allocated when the phase ended,
+            net of any freed, in bytes. Growth here that a later run
+            doesn't give back is what makes a process grow.
+        peak -- The most memory allocated at once during the phase,
+            above what was allocated when it began, in bytes.
+        sites -- The places (file and line) that allocated the most
+            memory still held at the end of the phase, largest first: a
+            list of dictionaries with the keys file, line, size (in
+            bytes) and count (of memory blocks).
+
+    '''
+    def __init__(self, top=TOP_SITES, frames=1):
+        '''Set up the profiler.
+
+        Keyword arguments:
+            top -- The number of allocation sites to record per phase.
+            frames -- The number of stack frames to record for each
+                allocation, if this profiler starts the tracing.
+
+        '''
+        self.top = top
+        self.frames = frames
+        self.phases = {}
+        self._started = False
+
+    def start(self):
+        '''Start tracing allocations, if not already tracing.'''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started = True
+
+    def stop(self):
+        '''Stop tracing allocations, if this profiler started it.'''
+        if self._started:
+            tracemalloc.stop()
+            self._started = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def _snapshot(self):
+        '''Take a snapshot of the allocations made by the code measured.'''
+        return tracemalloc.take_snapshot().filter_traces(_IGNORED)
+
+    @contextmanager
+    def phase(self, name):
+        '''Measure the memory allocated by a block of code.
+
+        The record is stored under the given name, replacing any earlier
+        phase of the same name.
+
+        '''
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('memory profiler is not started')
+        # Collect garbage first, so memory freed by earlier phases (but not
+        # yet reclaimed) isn't credited to this one.
+        gc.collect()
+        before = self._snapshot()
+        # Measure from after the snapshot, which is itself traced.
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        try:
+            yield
+        finally:
+            gc.collect()
+            current, peak = tracemalloc.get_traced_memory()
+            sites = [stat for stat in self._snapshot().compare_to(before,
+                                                                  'lineno')
+                     if stat.size_diff > 0][:self.top]
+            self.phases[name] = {
+                'allocated': current - start,
+                'peak': peak - start,
+                'sites': [{'file': stat.traceback[0].filename,
+                           'line': stat.traceback[0].lineno,
+                           'size': stat.size_diff,
+                           'count': stat.count_diff} for stat in sites]}
+
+def profile_memory(dbfilename=None, nationality=None, gender=None,
+                   romanisation=None, count=1000,
+                   batch_sizes=DEFAULT_BATCH_SIZES, backend=None,
+                   top=TOP_SITES, verbosity=0):
+    '''Profile the memory used in building, loading and generating.
+
+    These phases are measured, in order (see MemoryProfiler):
+        'db build' -- Building the database from the CSV files.
+        'pool load' -- Loading the name pools from the database.
+        'generation loop' -- Generating names one at a time, with
+            generate().
+        'transliteration' -- Transliterating every name with every
+            ruleset, one at a time (as generate() does when asked to
+            romanise names whose romanisations aren't precomputed).
+        'batch of N' -- Generating N names with generate_many(), for
+            each batch size N. The names generated are kept until the
+            end of the phase, as a caller would keep them. One batch is
+            generated beforehand, unmeasured, so one-time set-up isn't
+            charged to the first.
+
+    Keyword arguments:
+        dbfilename -- The database to build and load. If omitted, a
+            temporary database is built (and deleted afterwards), so the
+            default one is left alone.
+        nationality, gender -- The kind of names to generate. If
+            omitted, random values are chosen for each name.
+        romanisation -- A transliteration ruleset to romanise generated
+            names with.
+        count -- The number of names to generate in the generation loop.
+        batch_sizes -- The sizes of the batches to generate (each at
+            least 1).
+        backend -- The batch generation backend (see generate_many()).
+        top -- The number of allocation sites to record per phase.
+        verbosity -- The amount of diagnostic output.
+    Returns:
+        A dictionary with these keys:
+            phases -- A dictionary mapping each phase's name to its
+                record (see MemoryProfiler), in the order measured.
+            batches -- A dictionary mapping each batch size to the peak
+                memory used generating a batch of that size, in bytes.
+            peak -- The most memory allocated at once during any phase,
+                in bytes.
+
+    '''
+    if any(size < 1 for size in batch_sizes):
+        raise ValueError('batch sizes must be positive')
+    tmpdir = None
+    if dbfilename is None:
+        tmpdir = tempfile.mkdtemp(prefix='namechoose-')
+        dbfilename = os.path.join(tmpdir, os.path.basename(DEFAULT_DBFILE))
+    try:
+        with MemoryProfiler(top=top) as profiler:
+            if verbosity:
+                print('Profiling memory: building the database...')
+            with profiler.phase('db build'):
+                build_db(dbfilename=dbfilename)
+
+            if verbosity:
+                print('Profiling memory: loading name pools...')
+            with profiler.phase('pool load'):
+                pools = load_pools(dbfilename)
+
+            if verbosity:
+                print('Profiling memory: generating {} names one at a '
+                      'time...'.format(count))
+            with profiler.phase('generation loop'):
+                for _ in range(count):
+                    generate(nationality=nationality, gender=gender,
+                             pools=pools, romanisation=romanisation)
+
+            if verbosity:
+                print('Profiling memory: transliterating names...')
+            translit.clear_memo()
+            with profiler.phase('transliteration'):
+                for ruleset_id in translit.ruleset_ids():
+                    for row in range(len(pools)):
+                        translit.translit(pools.name(row), ruleset_id)
+
+            # Generate one batch unmeasured, so that one-time set-up (such
+            # as importing NumPy) isn't charged to the first batch size.
+            list(generate_many(1, nationality=nationality, gender=gender,
+                               pools=pools, backend=backend,
+                               romanisation=romanisation))
+            batches = {}
+            for size in batch_sizes:
+                if verbosity:
+                    print('Profiling memory: generating a batch of {} '
+                          'names...'.format(size))
+                name = 'batch of {}'.format(size)
+                with profiler.phase(name):
+                    names = list(generate_many(size, nationality=nationality,
+                                               gender=gender, pools=pools,
+                                               backend=backend,
+                                               romanisation=romanisation))
+                    del names
+                batches[size] = profiler.phases[name]['peak']
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {'phases': profiler.phases,
+            'batches': batches,
+            'peak': max(record['peak']
+                        for record in profiler.phases.values())}
+
+def dump_json(profile, fp=None, **kwargs):
+    '''Write a memory profile as JSON.
+
+    Keyword arguments:
+        profile -- The result of profile_memory().
+        fp -- A writable file object. If omitted, the JSON text is
+            returned instead of being written.
+        Any other keyword arguments are passed on to the json module.
+
+    '''
+    kwargs.setdefault('indent', 2)
+    if fp is None:
+        return json.dumps(profile, **kwargs)
+    json.dump(profile, fp, **kwargs)
+
+def _kib(size):
+    '''Convert a size in bytes to kibibytes.'''
+    return size / 1024
+
+def report(profile, file=None):
+    '''Print a human-readable summary of a memory profile.'''
+    if file is None:
+        file = sys.stderr
+    phases = profile['phases']
+    print('{:<24} {:>16} {:>16}'.format('Phase', 'Retained (KiB)',
+                                        'Peak (KiB)'),
+          file=file)
+    for name, record in phases.items():
+        print('{:<24} {:>16.1f} {:>16.1f}'.format(name,
+                                                  _kib(record['allocated']),
+                                                  _kib(record['peak'])),
+              file=file)
+    if profile.get('batches'):
+        print(file=file)
+        print('{:<24} {:>16} {:>16}'.format('Batch size', 'Peak (KiB)',
+                                            'Per name (B)'),
+              file=file)
+        for size, peak in profile['batches'].items():
+            print('{:<24} {:>16.1f} {:>16.1f}'.format(size, _kib(peak),
+                                                      peak / size),
+                  file=file)
+    for name, record in phases.items():
+        if not record['sites']:
+            continue
+        print(file=file)
+        print('Top allocation sites: {}'.format(name), file=file)
+        for site in record['sites']:
+            print('  {:>12.1f} KiB {:>8} blocks  {}:{}'.format(
+                      _kib(site['size']), site['count'],
+                      _relative(site['file']), site['line']),
+                  file=file)
+
+def _relative(filename):
+    '''Shorten a file name for display, if it's inside the package.'''
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if filename.startswith(package_dir + os.sep):
+        return os.path.relpath(filename, package_dir)
+    return filename
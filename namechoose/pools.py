@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+
+'''Hold the namechoose data in memory, indexed for random sampling.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from array import array
+import gc
+
+# Local library imports.
+from . import instrument, translit
+from .data import (getdata, data_version, nt_for, DEFAULT_DBFILE,
+                   DATA_COLUMNS, GENDERS, MASCULINE, FEMININE, NEUTER)
+
+__all__ = ['StringTable', 'NameRecord', 'NamePools', 'load_pools',
+           'freeze_for_fork']
+
+# Genders whose pools a name of a given gender belongs to. This mirrors the
+# behaviour of getdata(): searching for masculine or feminine names includes
+# neuter names as well, but searching for neuter names finds only those.
+SERVES_GENDERS = {MASCULINE: (MASCULINE,),
+                  FEMININE: (FEMININE,),
+                  NEUTER: (MASCULINE, FEMININE, NEUTER)}
+
+# Data sources, in a fixed order so that they can be stored as small integer
+# codes.
+SOURCES = tuple(sorted(DATA_COLUMNS))
+
+# The string ID used where a record has no value (e.g. a family name with no
+# gender counterpart).
+NO_STRING = 0xFFFFFFFF
+
+# The array type code for 32-bit unsigned integers, used for string IDs, byte
+# offsets and record numbers. ('L' is 64 bits wide on most 64-bit platforms,
+# which would double the size of those arrays.)
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+class StringTable:
+    '''A table of distinct strings, stored as one block of UTF-8 text.
+
+    String n occupies bytes offsets[n] to offsets[n + 1] of the text.
+    Keeping every string in a single buffer (rather than as thousands of
+    separate str objects) saves memory, and means that worker processes
+    forked from a parent that loaded the table can share its pages:
+    reading a string never writes to the buffer, so copy-on-write is not
+    triggered.
+
+    '''
+    __slots__ = ('_data', '_offsets')
+
+    def __init__(self, data, offsets):
+        '''Wrap existing string data.
+
+        Arguments:
+            data -- A bytes-like object holding UTF-8 text.
+            offsets -- A sequence of integer byte offsets, one more than
+                the number of strings.
+
+        '''
+        self._data = data
+        self._offsets = offsets
+
+    @classmethod
+    def build(cls, strings):
+        '''Build a table from a sequence of distinct strings.'''
+        data, offsets = bytearray(), array(UINT32, (0,))
+        for s in strings:
+            data.extend(s.encode('utf-8'))
+            offsets.append(len(data))
+        return cls(bytes(data), offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, n):
+        if n == NO_STRING:
+            return None
+        return str(self._data[self._offsets[n]:self._offsets[n + 1]],
+                   'utf-8')
+
+    def __iter__(self):
+        return (self[n] for n in range(len(self)))
+
+    @property
+    def nbytes(self):
+        '''The number of bytes used by the string data and offsets.'''
+        return (len(self._data) +
+                len(self._offsets) * memoryview(self._offsets).itemsize)
+
+class NameRecord:
+    '''A lightweight view of one record in a NamePools.
+
+    Field values are looked up from the pools' compact storage each time
+    they are accessed.
+
+    '''
+    __slots__ = ('_pools', '_row')
+
+    def __init__(self, pools, row):
+        self._pools = pools
+        self._row = row
+
+    source = property(lambda self: self._pools.source(self._row))
+    name = property(lambda self: self._pools.name(self._row))
+    romanisation = property(lambda self: self._pools.romanisation(self._row))
+    gender = property(lambda self: self._pools.gender(self._row))
+    nationality = property(lambda self: self._pools.nationality(self._row))
+
+    @property
+    def counterpart(self):
+        '''The gender counterpart of a family name.'''
+        return self._pools.extra(self._row) if self.source == 'family' else None
+
+    @property
+    def from_(self):
+        '''The name from which a patro-/matronymic is derived.'''
+        return (self._pools.extra(self._row) if self.source == 'pmatronymic'
+                else None)
+
+    def astuple(self):
+        '''Convert this record into a namedtuple, as getdata() returns.'''
+        source = self.source
+        return nt_for(source)._make(getattr(self, field)
+                                    for field in DATA_COLUMNS[source])
+
+    def __repr__(self):
+        return '<NameRecord {}>'.format(self.astuple())
+
+class NamePools:
+    '''All records from every data source, with a pool for each
+    combination of data source, nationality and gender.
+
+    Records are numbered from 0 across all data sources, and stored
+    column by column: string values as IDs into a single StringTable,
+    and data source, gender and nationality as small integer codes. A
+    pool is an array of record numbers.
+
+    Structures derived from the pools (generation plans, indices and the
+    like) are cached in the derived attribute, a dictionary, rather than
+    in module-level tables keyed on the pools. They can then refer back
+    to the pools without keeping discarded pools alive: the pools and
+    everything derived from them are freed together.
+
+    '''
+    # The version of the database the pools were loaded from (see
+    # data_version()), if known.
+    version = None
+
+    # Names of the per-record columns, and their array type codes.
+    COLUMNS = (('source', 'B'), ('name', UINT32), ('romanisation', UINT32),
+               ('gender', 'B'), ('nationality', 'B'), ('extra', UINT32))
+
+    def __init__(self, strings, nationalities, columns, pools,
+                 romanisations=None):
+        '''Wrap existing compact data. Use from_records() to build it.
+
+        Arguments:
+            strings -- A StringTable.
+            nationalities -- A sequence of nationality names; the
+                nationality column holds indices into it.
+            columns -- A mapping of the column names in COLUMNS to
+                sequences of integers.
+            pools -- A mapping of (source, nationality, gender) tuples
+                to sequences of record numbers.
+            romanisations -- A mapping of transliteration ruleset IDs
+                to 2-tuples of a StringTable and a sequence of string
+                IDs into it, one per record (see
+                precompute_romanisations()).
+
+        '''
+        self.strings = strings
+        self.nationalities = tuple(nationalities)
+        self._nat_codes = {nat: n for n, nat in enumerate(self.nationalities)}
+        self._columns = columns
+        (self._source, self._name, self._romanisation, self._gender,
+         self._nationality, self._extra) = (columns[col]
+                                            for col, _ in self.COLUMNS)
+        self._pools = pools
+        self._romanisations = dict(romanisations or {})
+        self.derived = {}
+
+    @classmethod
+    def from_records(cls, records):
+        '''Build compact pools from full records.
+
+        Arguments:
+            records -- A mapping of data source names to iterables of
+                records (namedtuples, as returned by getdata()).
+
+        '''
+        string_ids, nat_codes = {}, {}
+        def intern(s):
+            if s is None:
+                return NO_STRING
+            try:
+                return string_ids[s]
+            except KeyError:
+                string_ids[s] = len(string_ids)
+                return string_ids[s]
+
+        columns = {col: array(typecode) for col, typecode in cls.COLUMNS}
+        pools = {}
+        row = 0
+        for source_code, source in enumerate(SOURCES):
+            extra_field = {'family': 'counterpart',
+                           'pmatronymic': 'from_'}.get(source)
+            for record in records.get(source, ()):
+                if record.gender not in GENDERS:
+                    raise ValueError("unknown gender '{}' for name "
+                                     "'{}'".format(record.gender,
+                                                   record.name))
+                nat_code = nat_codes.setdefault(record.nationality,
+                                                len(nat_codes))
+                columns['source'].append(source_code)
+                columns['name'].append(intern(record.name))
+                columns['romanisation'].append(intern(record.romanisation))
+                columns['gender'].append(GENDERS.index(record.gender))
+                columns['nationality'].append(nat_code)
+                columns['extra'].append(intern(None if extra_field is None
+                                               else getattr(record,
+                                                            extra_field)))
+
+                for gender in SERVES_GENDERS[record.gender]:
+                    key = (source, record.nationality, gender)
+                    try:
+                        pools[key].append(row)
+                    except KeyError:
+                        pools[key] = array(UINT32, (row,))
+                row += 1
+
+        return cls(StringTable.build(string_ids), nat_codes, columns, pools)
+
+    def __len__(self):
+        return len(self._source)
+
+    def pool(self, source, nationality, gender):
+        '''Get the record numbers for a source, nationality and gender.
+
+        An empty sequence is returned if there are no matching records.
+
+        '''
+        return self._pools.get((source, nationality, gender), ())
+
+    def keys(self):
+        '''List the (source, nationality, gender) keys of all pools.'''
+        return self._pools.keys()
+
+    def record(self, row):
+        '''Get a lightweight view of a record by its number.'''
+        return NameRecord(self, row)
+
+    # Direct accessors for single fields, avoiding the cost of a view.
+    def source(self, row):
+        '''Get the data source of a record.'''
+        return SOURCES[self._source[row]]
+
+    def name(self, row):
+        '''Get the name (in its native script) of a record.'''
+        return self.strings[self._name[row]]
+
+    def name_id(self, row):
+        '''Get the string ID of a record's name.
+
+        Records with equal names have equal name IDs.
+
+        '''
+        return self._name[row]
+
+    @property
+    def name_ids(self):
+        '''The name string ID of every record, in record order.'''
+        return self._name
+
+    def romanisation(self, row):
+        '''Get the romanisation of a record (empty if not needed).'''
+        return self.strings[self._romanisation[row]]
+
+    def romanisation_by(self, row, ruleset_id):
+        '''Get the romanisation of a record under a given ruleset.
+
+        Returns:
+            The romanisation precomputed by precompute_romanisations(),
+            or None if that ruleset does not apply to the record.
+        Raises:
+            KeyError -- If romanisations under that ruleset have not
+                been precomputed.
+
+        '''
+        strings, ids = self._romanisations[ruleset_id]
+        return strings[ids[row]]
+
+    def gender(self, row):
+        '''Get the gender of a record.'''
+        return GENDERS[self._gender[row]]
+
+    def nationality(self, row):
+        '''Get the nationality of a record.'''
+        return self.nationalities[self._nationality[row]]
+
+    def extra(self, row):
+        '''Get the counterpart or source name of a record, if any.'''
+        return self.strings[self._extra[row]]
+
+    def assemble(self, rows, romanisation=None):
+        '''Get the parts of a name made up of the given records.
+
+        Arguments:
+            rows -- A sequence of record numbers, one per name part.
+            romanisation -- The identifier of a transliteration ruleset
+                with precomputed romanisations to use where it applies.
+                If omitted, the romanisations from the data are used.
+        Returns:
+            A 2-tuple of a list of the name parts in the original script
+            and a list of romanised name parts (empty if the original
+            script is Latin), as returned by generate().
+
+        '''
+        original_parts, romanised_parts = [], []
+        for row in rows:
+            original_parts.append(self.name(row))
+            romanised = (None if romanisation is None else
+                         self.romanisation_by(row, romanisation))
+            if romanised is None:
+                romanised = self.romanisation(row)
+            if romanised != '':
+                romanised_parts.append(romanised)
+        return original_parts, romanised_parts
+
+    def precompute_romanisations(self, ruleset_ids=None, filename=None):
+        '''Transliterate every applicable record under each ruleset.
+
+        A ruleset applies to records of the nationality whose ISO 639
+        code matches the ruleset's language. Afterwards, romanisations
+        are available from romanisation_by() without transliterating.
+
+        Keyword arguments:
+            ruleset_ids -- An iterable of ruleset identifiers. If
+                omitted, all rulesets in the file are used.
+            filename -- The name of a JSON file containing the rulesets.
+                If omitted, the default file is used.
+
+        '''
+        # Imported here to avoid a circular import.
+        from . import NAT_ABBREVS
+
+        if ruleset_ids is None:
+            ruleset_ids = translit.ruleset_ids(filename=filename)
+        for ruleset_id in ruleset_ids:
+            if ruleset_id in self._romanisations:
+                continue
+            ruleset = translit.ruleset_by_id(ruleset_id, filename)
+            if ruleset is None:
+                raise ValueError("unknown transliteration ruleset "
+                                 "'{}'".format(ruleset_id))
+            nat = NAT_ABBREVS.get(ruleset['lang'])
+            rows = [n for n in range(len(self)) if self.nationality(n) == nat]
+
+            with instrument.span('pools.romanise'):
+                romanised = translit.translit_many((self.name(n)
+                                                    for n in rows),
+                                                   ruleset_id, filename)
+            string_ids = {}
+            ids = array(UINT32, (NO_STRING,)) * len(self)
+            for n, s in zip(rows, romanised):
+                ids[n] = string_ids.setdefault(s, len(string_ids))
+            self._romanisations[ruleset_id] = (StringTable.build(string_ids),
+                                               ids)
+
+    def romanisation_rulesets(self):
+        '''List the rulesets with precomputed romanisations.'''
+        return list(self._romanisations)
+
+    def has_romanisations(self, ruleset_id):
+        '''Check whether romanisations under a ruleset are precomputed.'''
+        return ruleset_id in self._romanisations
+
+    @property
+    def nbytes(self):
+        '''An estimate of the bytes used by the compact data.'''
+        arrays = list(self._columns.values()) + list(self._pools.values())
+        size = self.strings.nbytes
+        for strings, ids in self._romanisations.values():
+            size += strings.nbytes
+            arrays.append(ids)
+        return size + sum(len(a) * memoryview(a).itemsize for a in arrays)
+
+def load_pools(dbfilename=DEFAULT_DBFILE, verbosity=0, rulesets=()):
+    '''Read every data source from the database into a NamePools.
+
+    Keyword arguments:
+        dbfilename -- The database file to read.
+        verbosity -- The amount of diagnostic output (see getdata()).
+        rulesets -- Transliteration rulesets whose romanisations should
+            be precomputed for every applicable record. Pass None for
+            all known rulesets. The default is none.
+
+    '''
+    with instrument.span('pools.load'):
+        # Read the version first: if the database is replaced while loading,
+        # the pools will look out of date rather than up to date.
+        version = data_version(dbfilename)
+        # Stream each data source, so that only one chunk of rows is held
+        # at a time (besides the compact pools themselves).
+        pools = NamePools.from_records({source: getdata(source,
+                                                        dbfilename=dbfilename,
+                                                        verbosity=verbosity,
+                                                        stream=True)
+                                        for source in DATA_COLUMNS})
+        pools.version = version
+    if rulesets is None or len(rulesets) > 0:
+        pools.precompute_romanisations(rulesets)
+    return pools
+
+def freeze_for_fork():
+    '''Prepare loaded pools to be shared with forked worker processes.
+
+    Call this in the parent process after loading, just before forking.
+    It moves every existing object out of reach of the cyclic garbage
+    collector, whose bookkeeping would otherwise write to (and so copy)
+    memory pages in each child.
+
+    '''
+    try:
+        gc.freeze()
+    except AttributeError:
+        # Python versions before 3.7 lack gc.freeze(). The compact storage
+        # is still shared; only the collector's bookkeeping is not.
+        pass
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+'''Look up names in their native script from romanised input.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+from bisect import bisect_left
+
+# Local library imports.
+from . import instrument, translit, resolve_pools
+from .filters import fold
+
+__all__ = ['fold', 'ReverseIndex', 'get_reverse_index']
+
+def _ngrams(key, n):
+    '''Get the set of n-grams of a key, padded to mark its ends.'''
+    padded = ' ' * (n - 1) + key + ' '
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+class ReverseIndex:
+    '''An index from romanised forms of names to their records.
+
+    Every record is indexed under its romanisation from the data (or its
+    name, if that is already in Latin script) and under each romanisation
+    precomputed in the pools when the index is built (listed in its
+    rulesets attribute). Keys are folded (see fold()), giving a hash
+    index for exact lookups; a sorted key list answers prefix lookups,
+    and an n-gram index answers fuzzy lookups.
+
+    '''
+    def __init__(self, pools, ngram=3, filename=None):
+        '''Build the index.
+
+        Arguments:
+            pools -- The NamePools whose records are indexed.
+            ngram -- The length of the n-grams used for fuzzy lookups.
+                If 0, fuzzy lookups are not supported.
+            filename -- The transliteration rules file, whose inverse
+                rulesets (if any) are used to turn romanised input back
+                into native script. If omitted, the default is used.
+
+        '''
+        self.pools = pools
+        self.ngram = ngram
+
+        self.rulesets = frozenset(pools.romanisation_rulesets())
+
+        with instrument.span('reverse.build'):
+            # Folded key -> record numbers.
+            self._exact = {}
+            # Folded native-script name -> record numbers.
+            self._native = {}
+            for row in range(len(pools)):
+                name = pools.name(row)
+                self._native.setdefault(fold(name), []).append(row)
+
+                forms = {pools.romanisation(row) or name}
+                for ruleset_id in self.rulesets:
+                    romanised = pools.romanisation_by(row, ruleset_id)
+                    if romanised is not None:
+                        forms.add(romanised)
+                for form in forms:
+                    rows = self._exact.setdefault(fold(form), [])
+                    if row not in rows:
+                        rows.append(row)
+
+            self._sorted_keys = sorted(self._exact)
+
+            # N-gram -> indices into _sorted_keys, and the number of distinct
+            # n-grams in each key.
+            self._grams = {}
+            self._gram_counts = []
+            if ngram > 0:
+                for n, key in enumerate(self._sorted_keys):
+                    key_grams = _ngrams(key, ngram)
+                    self._gram_counts.append(len(key_grams))
+                    for gram in key_grams:
+                        self._grams.setdefault(gram, []).append(n)
+
+            # Inverse rulesets (romanised script back to native script).
+            self._inverses = []
+            for ruleset_id in translit.ruleset_ids(filename=filename):
+                ruleset = translit.ruleset_by_id(ruleset_id, filename)
+                if ruleset.get('inverse') is not None:
+                    self._inverses.append(ruleset['inverse'])
+        self._filename = filename
+
+    def __len__(self):
+        return len(self._sorted_keys)
+
+    def _records(self, rows, nationality):
+        '''Turn record numbers into views, filtering by nationality.'''
+        return [self.pools.record(row) for row in rows
+                if nationality is None or
+                self.pools.nationality(row) == nationality]
+
+    def lookup(self, text, nationality=None):
+        '''Find the records whose romanisation matches some text.
+
+        Matching ignores case and diacritics. Where the transliteration
+        rules file provides inverse rulesets, the text is also converted
+        back to native script and matched against names.
+
+        Returns:
+            A list of NameRecord views, possibly empty.
+
+        '''
+        instrument.count('reverse_lookups')
+        key = fold(text)
+        rows = list(self._exact.get(key, ()))
+        for inverse in self._inverses:
+            native = fold(translit.translit(text, inverse, self._filename))
+            for row in self._native.get(native, ()):
+                if row not in rows:
+                    rows.append(row)
+        return self._records(rows, nationality)
+
+    def prefix(self, text, nationality=None, limit=None):
+        '''Find the records whose romanisation starts with some text.
+
+        Returns:
+            A list of NameRecord views, in order of romanisation, with at
+            most limit entries (if given).
+
+        '''
+        instrument.count('reverse_lookups')
+        key = fold(text)
+        results = []
+        n = bisect_left(self._sorted_keys, key)
+        while n < len(self._sorted_keys):
+            candidate = self._sorted_keys[n]
+            if not candidate.startswith(key):
+                break
+            results.extend(self._records(self._exact[candidate],
+                                         nationality))
+            if limit is not None and len(results) >= limit:
+                return results[:limit]
+            n += 1
+        return results
+
+    def fuzzy(self, text, nationality=None, limit=10, threshold=0.3):
+        '''Find the records whose romanisation is similar to some text.
+
+        Similarity is the Jaccard index of the two strings' n-gram sets.
+
+        Returns:
+            A list of 2-tuples of a similarity score (from 0 to 1) and a
+            NameRecord view, best match first, with at most limit
+            entries.
+
+        '''
+        if self.ngram <= 0:
+            raise ValueError('this index does not support fuzzy lookups')
+        instrument.count('reverse_lookups')
+        grams = _ngrams(fold(text), self.ngram)
+
+        # Count the n-grams each candidate key shares with the text.
+        shared = {}
+        for gram in grams:
+            for n in self._grams.get(gram, ()):
+                shared[n] = shared.get(n, 0) + 1
+
+        scored = []
+        for n, common in shared.items():
+            score = common / (len(grams) + self._gram_counts[n] - common)
+            if score >= threshold:
+                scored.append((score, self._sorted_keys[n]))
+        scored.sort(key=lambda pair: (-pair[0], pair[1]))
+
+        results = []
+        for score, key in scored:
+            for record in self._records(self._exact[key], nationality):
+                results.append((score, record))
+                if len(results) >= limit:
+                    return results
+        return results
+
+def get_reverse_index(pools=None):
+    '''Get the (cached) reverse index for some name pools.
+
+    The index is rebuilt if romanisations under more rulesets have been
+    precomputed in the pools since it was built, so that it covers them
+    too.
+
+    Arguments:
+        pools -- The NamePools (or Corpus) to index. If omitted, the
+            pools from the default database are used.
+
+    '''
+    pools = resolve_pools(pools)
+    # Indices are cached with the pools they refer to (see NamePools).
+    index = pools.derived.get('reverse_index')
+    if (index is None or
+        index.rulesets != frozenset(pools.romanisation_rulesets())):
+        index = pools.derived['reverse_index'] = ReverseIndex(pools)
+    return index
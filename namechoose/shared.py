@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+'''Share loaded name pools between processes without copying them.'''
+# Copyright © 2014, 2015 Timothy Pederick.
+#
+# This file is part of namechoose.
+#
+# Namechoose is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Namechoose is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with namechoose.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard library imports.
+import json
+import mmap
+import os
+import os.path
+import struct
+
+# Local library imports.
+from . import instrument
+from .pools import StringTable, NamePools
+
+__all__ = ['pack', 'unpack', 'publish', 'attach', 'save', 'open_mapped',
+           'SharedPools', 'MappedPools']
+
+# Packed pools layout:
+# * 8 bytes: the magic string MAGIC.
+# * 8 bytes: the total length of the packed data, and 8 bytes: the length of
+#      the header, both as little-endian unsigned integers.
+# * The header: UTF-8 JSON describing the nationalities and each array
+#      segment.
+# * Each array segment, in native byte order, starting on an 8-byte boundary.
+# * A trailer of segment offsets (8 bytes each, little-endian). Keeping these
+#      out of the header means the header's length doesn't depend on them.
+MAGIC = b'NCPOOL01'
+_PREAMBLE = struct.Struct('<8sQQ')
+_ALIGN = 8
+
+def _aligned(n):
+    '''Round n up to a multiple of _ALIGN.'''
+    return -(-n // _ALIGN) * _ALIGN
+
+def _typecode(seq):
+    '''Get the item type code of an array or memoryview.'''
+    try:
+        return seq.typecode
+    except AttributeError:
+        return seq.format
+
+def pack(pools):
+    '''Serialise a NamePools into a single bytes object.'''
+    segments, blobs = [], []
+    def add(kind, key, typecode, data):
+        blobs.append(bytes(data))
+        segments.append([kind, key, typecode, len(blobs[-1])])
+
+    add('strings', None, 'B', pools.strings._data)
+    add('offsets', None, _typecode(pools.strings._offsets),
+        pools.strings._offsets)
+    for col, typecode in NamePools.COLUMNS:
+        add('column', col, typecode, pools._columns[col])
+    for key in pools.keys():
+        pool = pools.pool(*key)
+        add('pool', list(key), _typecode(pool), pool)
+    for ruleset_id, (strings, ids) in pools._romanisations.items():
+        add('rom_strings', ruleset_id, 'B', strings._data)
+        add('rom_offsets', ruleset_id, _typecode(strings._offsets),
+            strings._offsets)
+        add('rom_ids', ruleset_id, _typecode(ids), ids)
+
+    # Lay out the segments after the header.
+    header = {'nationalities': list(pools.nationalities),
+              'version': pools.version,
+              'segments': segments}
+    header_bytes = json.dumps(header).encode('utf-8')
+    pos = _aligned(_PREAMBLE.size + len(header_bytes))
+    offsets = []
+    for blob in blobs:
+        offsets.append(pos)
+        pos = _aligned(pos + len(blob))
+
+    out = bytearray(pos + 8 * len(offsets))
+    _PREAMBLE.pack_into(out, 0, MAGIC, len(out), len(header_bytes))
+    out[_PREAMBLE.size:_PREAMBLE.size + len(header_bytes)] = header_bytes
+    for offset, blob in zip(offsets, blobs):
+        out[offset:offset + len(blob)] = blob
+    struct.pack_into('<{}Q'.format(len(offsets)), out, pos, *offsets)
+    return bytes(out)
+
+def unpack(buffer, cls=NamePools):
+    '''Build a NamePools over packed data, without copying it.
+
+    Arguments:
+        buffer -- A bytes-like object holding the output of pack().
+        cls -- The class to instantiate (NamePools or a subclass).
+    Returns:
+        An instance of cls whose arrays are memoryviews of buffer. The
+        views it holds are also listed in its _views attribute.
+
+    '''
+    view = memoryview(buffer)
+    magic, total_len, header_len = _PREAMBLE.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError('not a packed namechoose pools buffer')
+    # Shared memory blocks may be rounded up in size; ignore any excess.
+    view = view[:total_len]
+    header = json.loads(str(view[_PREAMBLE.size:
+                                 _PREAMBLE.size + header_len], 'utf-8'))
+    segments = header['segments']
+    trailer = len(view) - 8 * len(segments)
+    offsets = struct.unpack_from('<{}Q'.format(len(segments)), view, trailer)
+
+    views = [view]
+    strings_data = strings_offsets = None
+    columns, pools, romanisations = {}, {}, {}
+    for (kind, key, typecode, length), offset in zip(segments, offsets):
+        segment = view[offset:offset + length].cast(typecode)
+        views.append(segment)
+        if kind == 'strings':
+            strings_data = segment
+        elif kind == 'offsets':
+            strings_offsets = segment
+        elif kind == 'column':
+            columns[key] = segment
+        elif kind == 'pool':
+            pools[tuple(key)] = segment
+        else:
+            romanisations.setdefault(key, {})[kind] = segment
+
+    romanisations = {ruleset_id: (StringTable(parts['rom_strings'],
+                                              parts['rom_offsets']),
+                                  parts['rom_ids'])
+                     for ruleset_id, parts in romanisations.items()}
+    pools = cls(StringTable(strings_data, strings_offsets),
+                header['nationalities'], columns, pools, romanisations)
+    pools.version = header.get('version')
+    pools._views = views
+    return pools
+
+def _release(views):
+    '''Release memoryviews (derived views first) so a buffer can close.'''
+    for view in reversed(views):
+        view.release()
+
+class SharedPools(NamePools):
+    '''Name pools stored in a block of shared memory.
+
+    Instances can be passed wherever a NamePools is accepted. Call
+    close() when finished with them; the process that published them
+    should also call unlink() once no other process needs them.
+
+    '''
+    _shm = None
+
+    @property
+    def shm_name(self):
+        '''The name by which other processes can attach to the pools.'''
+        return self._shm.name
+
+    def close(self):
+        '''Detach from the shared memory. The pools become unusable.'''
+        _release(self._views)
+        self._shm.close()
+
+    def unlink(self):
+        '''Request that the shared memory be destroyed.'''
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def publish(pools, name=None):
+    '''Copy name pools into a new block of shared memory.
+
+    Arguments:
+        pools -- The NamePools to publish.
+        name -- The name to give the shared memory block. If omitted, a
+            unique name is generated.
+    Returns:
+        A SharedPools instance. Its shm_name attribute can be passed to
+        attach() in other processes.
+
+    '''
+    from multiprocessing import shared_memory
+
+    with instrument.span('shared.publish'):
+        data = pack(pools)
+        shm = shared_memory.SharedMemory(name=name, create=True,
+                                         size=len(data))
+        shm.buf[:len(data)] = data
+        shared = unpack(shm.buf.toreadonly(), cls=SharedPools)
+        shared._shm = shm
+    return shared
+
+def attach(name):
+    '''Attach, read-only, to name pools published by another process.'''
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    with instrument.span('shared.attach'):
+        try:
+            # Python 3.13 and later: don't let this process's resource
+            # tracker destroy the block when this process exits.
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+            # Earlier versions always register the block with the resource
+            # tracker. Child processes started by multiprocessing share their
+            # parent's tracker, so that's harmless; any other process must
+            # unregister it, or the block is destroyed when that process
+            # exits.
+            if multiprocessing.parent_process() is None:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        shared = unpack(shm.buf.toreadonly(), cls=SharedPools)
+        shared._shm = shm
+    return shared
+
+class MappedPools(NamePools):
+    '''Name pools read from a memory-mapped file.
+
+    The operating system shares the file's pages between all processes
+    that map it. Call close() when finished with the pools.
+
+    '''
+    _mmap = None
+
+    def close(self):
+        '''Unmap the file. The pools become unusable.'''
+        _release(self._views)
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+def save(pools, filename):
+    '''Write name pools to a file, for later use with open_mapped().
+
+    The file is replaced atomically, so processes that have the old file
+    mapped carry on using it undisturbed.
+
+    '''
+    tmpfilename = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmpfilename, mode='wb') as f:
+            f.write(pack(pools))
+        os.replace(tmpfilename, filename)
+    except BaseException:
+        if os.path.exists(tmpfilename):
+            os.remove(tmpfilename)
+        raise
+
+def open_mapped(filename):
+    '''Map a file written by save() into memory, read-only.'''
+    with instrument.span('shared.map'):
+        with open(filename, mode='rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        pools = unpack(mapped, cls=MappedPools)
+        pools._mmap = mapped
+    return pools
@@ -17,16 +17,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Standard library imports.
-from collections import OrderedDict
+from collections import namedtuple, OrderedDict
 import json
 import os.path
 import re
 
+# Local library imports.
+from . import instrument
+
 # LRU caches.
 _CACHE_LIMIT = 10
 _cached_rulefiles = OrderedDict()
 _cached_rulesets = OrderedDict()
 
+# LRU cache of transliteration results, keyed by (filename, ruleset ID,
+# string). Name parts repeat often, so even a modest cache saves most of the
+# work of transliterating them.
+MEMO_LIMIT = 4096
+_memo = OrderedDict()
+
 # Locate the data file.
 THIS_DIR = os.path.dirname(__file__)
 DATA_DIR = os.path.join(THIS_DIR, 'dat')
@@ -37,6 +46,14 @@ DEFAULT_FILENAME = os.path.join(DATA_DIR, 'translit.json')
 # Bicameral scripts have bicameral transliteration rules.
 BICAMERAL = ['Armn', 'Cyrl', 'Grek', 'Latn']
 
+# A name whose romanisation doesn't follow a ruleset.
+Mismatch = namedtuple('Mismatch', 'name romanisation expected')
+
+# A rule that can never take effect: its index in the ruleset, its regex,
+# the kind of problem ('empty', 'duplicate' or 'shadowed') and the indices
+# of the earlier rules responsible (if any).
+RuleProblem = namedtuple('RuleProblem', 'index pattern problem culprits')
+
 def ruleset_by_id(ruleset_id, filename=None):
     """Load a transliteration ruleset from a file.
 
@@ -54,36 +71,82 @@ def ruleset_by_id(ruleset_id, filename=None):
         from_cache = _cached_rulesets[(filename, ruleset_id)]
         # Update the recent-use status of this cache entry.
         _cached_rulesets.move_to_end((filename, ruleset_id))
+        instrument.count('ruleset_cache_hits')
 
         return from_cache
     except KeyError:
-        # This ruleset is not cached. Is the file it's in cached?
-        try:
-            rulefile = _cached_rulefiles[filename]
-            # Update the recent-use status of this cache entry.
-            _cached_rulefiles.move_to_end(filename)
-        except KeyError:
-            # Nope. Load the file.
-            rulefile = json.load(open(filename))
-            _cached_rulefiles[filename] = rulefile
-
-            # Maintain the LRU cache size.
-            if len(_cached_rulefiles) > _CACHE_LIMIT:
-                _cached_rulefiles.popitem()
-
-        ruleset = rulefile.get(ruleset_id)
+        instrument.count('ruleset_cache_misses')
+        # This ruleset is not cached. Get it from the file.
+        ruleset = _rulefile(filename).get(ruleset_id)
         if ruleset is not None:
             # Compile the regexes in this ruleset.
             ruleset['rules'] = list((re.compile(regex), output)
                                     for regex, output in ruleset['rules'])
+            ruleset['pattern'] = _combine(ruleset['rules'])
 
         _cached_rulesets[(filename, ruleset_id)] = ruleset
         # Maintain the LRU cache size.
         if len(_cached_rulesets) > _CACHE_LIMIT:
-            _cached_rulesets.popitem()
+            _cached_rulesets.popitem(last=False)
 
         return ruleset
 
+def _combine(rules):
+    """Combine a ruleset's regexes into one, tried in the same order.
+
+    Each rule becomes a named group in a single alternation, so the
+    regex engine tries every rule in one pass instead of one call per
+    rule per character. The alternatives are tried left to right and
+    the first to match wins, just as the rules are tried in order.
+
+    Returns:
+        The compiled regex, or None if the rules can't be combined
+        (they use numbered backreferences or group names, which would
+        change meaning).
+
+    """
+    if any(re.search(r'\\[1-9]|\(\?P', regex.pattern)
+           for regex, _ in rules):
+        return None
+    return re.compile('|'.join('(?P<r{}>{})'.format(i, regex.pattern)
+                               for i, (regex, _) in enumerate(rules)))
+
+def _rulefile(filename):
+    """Load (or fetch from the cache) a file of rulesets."""
+    try:
+        rulefile = _cached_rulefiles[filename]
+        # Update the recent-use status of this cache entry.
+        _cached_rulefiles.move_to_end(filename)
+    except KeyError:
+        # Not cached. Load the file.
+        with open(filename, encoding='utf-8') as f:
+            rulefile = json.load(f)
+        _cached_rulefiles[filename] = rulefile
+
+        # Maintain the LRU cache size.
+        if len(_cached_rulefiles) > _CACHE_LIMIT:
+            _cached_rulefiles.popitem(last=False)
+    return rulefile
+
+def ruleset_ids(lang=None, filename=None):
+    """List the identifiers of the rulesets in a file.
+
+    Keyword arguments:
+        lang -- If given, only rulesets for this language (an ISO 639
+            code, such as 'ru') are listed.
+        filename -- The name of a JSON file containing transliteration
+            rulesets. If omitted, the default file is used.
+    Returns:
+        A list of ruleset identifiers, highest priority first.
+
+    """
+    if filename is None:
+        filename = DEFAULT_FILENAME
+    rulefile = _rulefile(filename)
+    return sorted((ruleset_id for ruleset_id, ruleset in rulefile.items()
+                   if lang is None or ruleset['lang'] == lang),
+                  key=lambda ruleset_id: -rulefile[ruleset_id]['priority'])
+
 def translit(s, ruleset_id, filename=None):
     """Transliterate a string according to a given set of rules.
 
@@ -95,11 +158,68 @@ def translit(s, ruleset_id, filename=None):
             set by the ruleset() function is used.
 
     """
+    if filename is None:
+        filename = DEFAULT_FILENAME
+    key = (filename, ruleset_id, s)
+    try:
+        result = _memo[key]
+        _memo.move_to_end(key)
+        instrument.count('translit_memo_hits')
+        return result
+    except KeyError:
+        pass
+
+    with instrument.span('translit'):
+        result = _translit(s, ruleset_id, filename)
+    _memo[key] = result
+    if len(_memo) > MEMO_LIMIT:
+        _memo.popitem(last=False)
+    return result
+
+def translit_many(strings, ruleset_id, filename=None):
+    """Transliterate many strings according to a given set of rules.
+
+    Each distinct string is transliterated only once.
+
+    Keyword arguments:
+        strings -- An iterable of strings to transliterate.
+        ruleset_id -- The identifier for the set of rules to use.
+        filename -- The name of a JSON file containing the
+            transliteration ruleset. If omitted, the default file is
+            used.
+    Returns:
+        A list of the transliterated strings, in the same order.
+
+    """
+    done = {}
+    results = []
+    for s in strings:
+        try:
+            results.append(done[s])
+        except KeyError:
+            done[s] = translit(s, ruleset_id, filename)
+            results.append(done[s])
+    return results
+
+def clear_memo():
+    """Discard all memoised transliteration results."""
+    _memo.clear()
+
+def _translit(s, ruleset_id, filename):
+    """Transliterate a string (the uninstrumented implementation)."""
     ruleset = ruleset_by_id(ruleset_id, filename)
     if ruleset is None:
         # No transliteration rules available. Return the string unchanged.
         return s
 
+    pattern = ruleset.get('pattern')
+    if pattern is not None:
+        # Scanning with the combined regex does the same as the loop below:
+        # characters that no rule matches are copied through unchanged.
+        rules = ruleset['rules']
+        return pattern.sub(lambda match: rules[int(match.lastgroup[1:])][1],
+                           s)
+
     result = []
     pos = 0
     while pos < len(s):
@@ -132,3 +252,177 @@ def is_translit(expected, s, ruleset_id, filename=None):
             return actual_translit.casefold() == expected.casefold()
         except AttributeError:
             return actual_translit.lower() == expected.lower()
+
+def check_translits(pairs, ruleset_id, filename=None):
+    """Check many romanisations against a set of rules at once.
+
+    Each distinct name is transliterated only once, and the comparison
+    (case-sensitive or not) is decided once for the whole ruleset.
+
+    Keyword arguments:
+        pairs -- An iterable of (name, romanisation) pairs.
+        ruleset_id -- The identifier for the set of rules to check
+            against.
+        filename -- The name of a JSON file containing the
+            transliteration ruleset. If omitted, the default file is
+            used.
+    Returns:
+        A list of Mismatch records, one for each pair whose romanisation
+        differs from the transliteration of its name, in the same order.
+
+    """
+    if filename is None:
+        filename = DEFAULT_FILENAME
+    ruleset = ruleset_by_id(ruleset_id, filename)
+    if ruleset is None:
+        raise ValueError("unknown transliteration ruleset "
+                         "'{}'".format(ruleset_id))
+    # Don't case-fold bicameral scripts.
+    fold = ((lambda s: s) if ruleset['from_script'] in BICAMERAL else
+            str.casefold)
+
+    mismatches = []
+    with instrument.span('translit.check'):
+        # Distinct name -> (expected transliteration, its folded form).
+        # This bypasses the memo, which is too small to hold a whole
+        # table's names and would only evict more useful entries.
+        expected = {}
+        for name, romanisation in pairs:
+            try:
+                exp, folded = expected[name]
+            except KeyError:
+                exp = _translit(name, ruleset_id, filename)
+                folded = fold(exp)
+                expected[name] = (exp, folded)
+            if fold(romanisation) != folded:
+                mismatches.append(Mismatch(name, romanisation, exp))
+    return mismatches
+
+# Zero-width assertions that may open or close a rule's regex.
+_LEADING_CONTEXT = re.compile(r'^(?:\^|\\[bA]|\(\?<[=!](?:[^()\\]|\\.)*\))*')
+_TRAILING_CONTEXT = re.compile(r'(?:\$|\\[bZ]|\(\?[=!](?:[^()\\]|\\.)*\))*$')
+# Characters that make a regex more than a literal string.
+_SPECIAL = re.compile(r'[.^$*+?{}\[\]()|\\]')
+# Assertions whose outcome depends on the text around a match.
+_ASSERTION = re.compile(r'\(\?<?[=!]|\\[bBAZ]|[$^]')
+
+def _alternatives(pattern):
+    """Split a regex at its top-level '|' operators."""
+    alternatives = []
+    depth = 0
+    in_class = escaped = False
+    start = 0
+    for pos, c in enumerate(pattern):
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif in_class:
+            in_class = (c != ']')
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            alternatives.append(pattern[start:pos])
+            start = pos + 1
+    alternatives.append(pattern[start:])
+    return alternatives
+
+def _split_context(alternative):
+    """Split a regex into its leading context, core and trailing context.
+
+    The contexts are the zero-width assertions (such as word boundaries
+    and lookarounds) at either end, which say where the core may match
+    without consuming any characters.
+
+    """
+    lead = _LEADING_CONTEXT.match(alternative).group()
+    rest = alternative[len(lead):]
+    trail = _TRAILING_CONTEXT.search(rest).group()
+    return lead, rest[:len(rest) - len(trail)], trail
+
+def _shadows(earlier, later):
+    """Determine whether one regex matches wherever another one does.
+
+    Only a later regex whose core is a literal string is considered; the
+    earlier one must match a prefix of that string under the same (or no)
+    leading context, and with no trailing context unless it consumes the
+    whole string under the same one.
+
+    """
+    e_lead, e_core, e_trail = earlier
+    l_lead, l_core, l_trail = later
+    if (_SPECIAL.search(l_core) or _ASSERTION.search(e_core) or
+        e_lead not in ('', l_lead)):
+        return False
+    try:
+        match = re.match(e_core, l_core)
+    except re.error:
+        return False
+    if match is None:
+        return False
+    return (e_trail == '' or
+            (match.end() == len(l_core) and e_trail == l_trail))
+
+def lint_ruleset(ruleset_id, filename=None):
+    """Find rules in a ruleset that can never take effect.
+
+    Rules are tried in order at each position, and the first to match
+    wins, so a rule is dead if an earlier one always matches wherever it
+    would. Dead rules never change a transliteration, but every one of
+    them is still tried on every character. The check is conservative:
+    it only reports rules that are certainly dead, and only recognises
+    shadowing of rules that match literal text (possibly between
+    assertions like word boundaries and lookarounds).
+
+    Keyword arguments:
+        ruleset_id -- The identifier for the set of rules to check.
+        filename -- The name of a JSON file containing the
+            transliteration ruleset. If omitted, the default file is
+            used.
+    Returns:
+        A list of RuleProblem records, in rule order.
+
+    """
+    ruleset = ruleset_by_id(ruleset_id, filename)
+    if ruleset is None:
+        raise ValueError("unknown transliteration ruleset "
+                         "'{}'".format(ruleset_id))
+
+    problems = []
+    seen = {}
+    parsed = []
+    for index, (regex, _) in enumerate(ruleset['rules']):
+        pattern = regex.pattern
+        alternatives = [_split_context(alternative)
+                        for alternative in _alternatives(pattern)]
+        if regex.match('') is not None:
+            # This would also stall the transliteration loop. It's reported
+            # on its own, rather than as shadowing every later rule.
+            parsed.append([])
+            problems.append(RuleProblem(index, pattern, 'empty', ()))
+            continue
+        parsed.append(alternatives)
+        if pattern in seen:
+            problems.append(RuleProblem(index, pattern, 'duplicate',
+                                        (seen[pattern],)))
+        else:
+            # Shadowed if each alternative is shadowed by some earlier
+            # rule (that is, by any alternative of it).
+            culprits = []
+            for later in alternatives:
+                for earlier_index in range(index):
+                    if any(_shadows(earlier, later)
+                           for earlier in parsed[earlier_index]):
+                        culprits.append(earlier_index)
+                        break
+                else:
+                    break
+            else:
+                problems.append(RuleProblem(index, pattern, 'shadowed',
+                                            tuple(sorted(set(culprits)))))
+        seen.setdefault(pattern, index)
+    return problems
@@ -21,14 +21,63 @@ __author__ = 'Timothy Pederick'
 __copyright__ = 'Copyright © 2014, 2015 Timothy Pederick'
 
 # Standard library imports.
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 import codecs
+import csv
+import itertools
+import json
+import os
+import sqlite3
 import sys
 
 # Local library import.
-from namechoose import generate, nat_lookup, MASCULINE, FEMININE
-from namechoose.data import build_db
-from namechoose.checkdata import validate_data
+from namechoose import (generate, nat_lookup, MASCULINE, FEMININE, NameFilter,
+                        Corpus, constrained_choices)
+from namechoose import instrument, translit
+from namechoose.batch import generate_many, parse_mix, BACKENDS
+from namechoose.keyed import name_for_key
+from namechoose.data import build_db, import_corpus, DATA_COLUMNS
+from namechoose.checkdata import (validate_data, check_backend,
+                                  benchmark_backend)
+from namechoose import backends
+from namechoose.corpus import get_engine_cache, DEFAULT_MAX_ENGINES
+
+def batch_sizes(spec):
+    '''Parse a comma-separated list of batch sizes (for --batch-sizes).'''
+    try:
+        sizes = [int(n) for n in spec.split(',')]
+    except ValueError:
+        raise ArgumentTypeError("invalid batch sizes '{}'".format(spec))
+    if any(size < 1 for size in sizes):
+        raise ArgumentTypeError('batch sizes must be positive')
+    return sizes
+
+def positive_int(value):
+    '''Parse a positive integer (for --max-corpora).'''
+    try:
+        n = int(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid integer '{}'".format(value))
+    if n < 1:
+        raise ArgumentTypeError('must be positive')
+    return n
+
+def positive_float(value):
+    '''Parse a positive number (for --corpus-memory).'''
+    try:
+        x = float(value)
+    except ValueError:
+        raise ArgumentTypeError("invalid number '{}'".format(value))
+    if not 0 < x < float('inf'):
+        raise ArgumentTypeError('must be positive and finite')
+    return x
+
+def mix_spec(spec):
+    '''Parse a distribution of nationalities (for --mix).'''
+    try:
+        return parse_mix(spec)
+    except ValueError as ve:
+        raise ArgumentTypeError(ve.args[0])
 
 def argparser():
     '''Construct the command-line argument parser.'''
@@ -38,6 +87,12 @@ def argparser():
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help=('show detailed information (may be specified '
                               'twice for extra detail)'))
+    parser.add_argument('--profile', action='store_true',
+                        help=('report timings and counters to standard error '
+                              'when finished'))
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help=('write timings and counters as JSON to the '
+                              'named file when finished'))
 
     action = parser.add_mutually_exclusive_group()
     action.add_argument('-G', '--generate', action='store_const',
@@ -47,9 +102,54 @@ def argparser():
                         const='validate', dest='action',
                         help=('rebuild and validate the database (instead of '
                               'generating a name)'))
+    action.add_argument('-I', '--import', nargs=2,
+                        metavar=('SOURCE', 'CSVFILE'), dest='import_corpus',
+                        help=('add the names in a CSV file to the database, '
+                              'as names of the given kind (one of: {})'.format(
+                                  ', '.join(sorted(DATA_COLUMNS)))))
+    action.add_argument('--memprofile', action='store_const',
+                        const='memprofile', dest='action',
+                        help=('report the memory allocated by each phase of '
+                              'building the database, loading it and '
+                              'generating names (in a temporary database), '
+                              'and the sites allocating the most'))
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help=('when importing, skip invalid records instead '
+                              'of stopping at the first one'))
     parser.add_argument('--skip-rebuild', action='store_true',
                         help=("don't rebuild the database when performing "
                               "validation"))
+    parser.add_argument('--check-storage', action='store_true',
+                        help=('when performing validation, also check and '
+                              'benchmark every storage backend'))
+    parser.add_argument('--batch-sizes', metavar='N[,N...]',
+                        type=batch_sizes,
+                        help=('when profiling memory, the batch sizes to '
+                              'measure peak memory for (defaults to '
+                              '1,100,10000)'))
+    parser.add_argument('--memprofile-json', metavar='FILE',
+                        help=('when profiling memory, also write the results '
+                              'as JSON to the named file'))
+    storage_args = parser.add_mutually_exclusive_group()
+    storage_args.add_argument('-s', '--storage',
+                              choices=sorted(backends.BACKENDS),
+                              help=('the storage backend to read names from '
+                                    '(defaults to the {} environment '
+                                    'variable, if set)'.format(
+                                        backends.BACKEND_ENVVAR)))
+    storage_args.add_argument('--corpus', metavar='DBFILE',
+                              help=('generate names from this database '
+                                    'instead of the default one (it is built '
+                                    'if it does not exist)'))
+    parser.add_argument('--max-corpora', type=positive_int, metavar='N',
+                        default=DEFAULT_MAX_ENGINES,
+                        help=('the most databases (from --corpus or '
+                              '--stdin requests) to hold in memory at once '
+                              '(defaults to {})'.format(DEFAULT_MAX_ENGINES)))
+    parser.add_argument('--corpus-memory', type=positive_float,
+                        metavar='MIB',
+                        help=('the most memory, in MiB, that databases held '
+                              'in memory may use in total'))
 
     gen_args = parser.add_argument_group('Generation options')
     gen_args.add_argument('-o', '--outfile', help=('write output to the named '
@@ -61,14 +161,56 @@ def argparser():
     gen_args.add_argument('-c', '--count', type=int, default=1,
                           help=('the number of names to generate (defaults '
                                 'to 1)'))
-    gen_args.add_argument('-n', '--nat', help=('the nationality of the '
+    nat_args = gen_args.add_mutually_exclusive_group()
+    nat_args.add_argument('-n', '--nat', help=('the nationality of the '
                                                'name(s) to be generated; '
                                                'either a full name, such as '
                                                '"Russian", or an ISO 639 two- '
                                                'or three-letter code, such as '
                                                '"ru"'))
+    nat_args.add_argument('-m', '--mix', metavar='SPEC', type=mix_spec,
+                          help=('the proportion of names to generate of each '
+                                'nationality, such as "en=0.6,es=0.2,ja=0.2"'))
     gen_args.add_argument('-g', '--gender', choices=[MASCULINE, FEMININE],
                           help='the gender of the name(s) generated')
+    gen_args.add_argument('-r', '--romanise', metavar='RULESET',
+                          choices=translit.ruleset_ids(),
+                          help=('romanise names with the named '
+                                'transliteration standard, where it applies '
+                                '(one of: {})'.format(
+                                    ', '.join(translit.ruleset_ids()))))
+    gen_args.add_argument('--initial', metavar='LETTERS',
+                          help=('only choose names beginning with one of '
+                                'these letters'))
+    gen_args.add_argument('--max-length', type=int, metavar='N',
+                          help=('only choose names of at most N characters '
+                                '(per name part)'))
+    gen_args.add_argument('--script', action='append', metavar='SCRIPT',
+                          help=('only choose names written in this script, '
+                                'such as Latin or Cyrillic (may be given more '
+                                'than once)'))
+    gen_args.add_argument('--deny', metavar='FILE',
+                          help=('never choose the names listed (one per line) '
+                                'in this file'))
+    gen_args.add_argument('--stdin', action='store_true',
+                          help=('read requests (nationality, gender, count '
+                                'and optional key) from standard input, one '
+                                'per line, and write the names generated for '
+                                'each'))
+    gen_args.add_argument('--input-format', choices=['auto', 'jsonl', 'csv'],
+                          default='auto',
+                          help=('the format of requests read with --stdin '
+                                '(by default, JSON Lines if the first request '
+                                'starts with "{", otherwise CSV)'))
+    gen_args.add_argument('--salt', default='',
+                          help=('a secret that changes which name each '
+                                'request key maps to'))
+    gen_args.add_argument('-b', '--batch', action='store_true',
+                          help=('generate all names in one batch from data '
+                                'held in memory (faster for large counts)'))
+    gen_args.add_argument('--backend', choices=BACKENDS,
+                          help=('the batch generation backend to use '
+                                '(defaults to numpy if it is installed)'))
 
     return parser
 
@@ -76,22 +218,232 @@ def main():
     '''Run the command-line utility.'''
     # Parse command line arguments.
     args = argparser().parse_args()
+    if args.profile or args.profile_json:
+        instrument.enable()
+    try:
+        run(args)
+    finally:
+        if args.profile:
+            instrument.report()
+        if args.profile_json:
+            with open(args.profile_json, mode='wt', encoding='utf-8') as jf:
+                instrument.dump_json(jf)
+
+# Fields of --stdin requests and responses.
+REQUEST_FIELDS = ('nationality', 'gender', 'count', 'key', 'corpus')
+RESPONSE_FIELDS = ('request', 'key', 'name', 'romanised', 'gender',
+                   'nationality')
+
+def read_requests(infile, fmt='auto'):
+    '''Read requests from a file of JSON Lines or CSV, one at a time.
+
+    CSV input must start with a header row naming its columns (from
+    REQUEST_FIELDS); with JSON Lines, each line is an object with those
+    keys. Blank lines are ignored.
+
+    Arguments:
+        infile -- The file to read.
+        fmt -- 'jsonl', 'csv' or 'auto' (JSON Lines if the first request
+            starts with '{', otherwise CSV).
+    Returns:
+        A 2-tuple of the format read and an iterator over 2-tuples of
+        the request number (counting from 1) and either a dict of the
+        request's fields or, if the request can't be read, a ValueError.
+
+    '''
+    lines = (line for line in infile if line.strip())
+    if fmt == 'auto':
+        try:
+            first = next(lines)
+        except StopIteration:
+            return 'jsonl', iter(())
+        fmt = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+        lines = itertools.chain((first,), lines)
+
+    def jsonl_requests():
+        for n, line in enumerate(lines, start=1):
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('expected a JSON object')
+            except ValueError as ve:
+                yield n, ValueError(str(ve))
+            else:
+                yield n, request
+
+    if fmt == 'jsonl':
+        return fmt, jsonl_requests()
+    return fmt, enumerate(csv.DictReader(lines), start=1)
+
+def serve_requests(infile, outfile, args, pools=None, constraints=None):
+    '''Generate names for each request read from a file.
+
+    Requests are handled one at a time, and the output is flushed after
+    each, so only one request's names are buffered at once. Writing to a
+    full pipe blocks, so no more requests are read until the reader
+    catches up.
+
+    Each request's nationality and gender default to those given on the
+    command line. Names are drawn from the existing database named by the
+    request's corpus field, if any (see Corpus), or else from the given
+    pools. A request with a key gets the name the key maps to (see
+    name_for_key(); constraints don't apply); otherwise, it gets count
+    random names (one, by default). Responses are written in the
+    same format as the requests. Requests that can't be satisfied are
+    reported on standard error and skipped.
+
+    '''
+    fmt, requests = read_requests(infile, args.input_format)
+    if fmt == 'csv':
+        writer = csv.writer(outfile)
+        writer.writerow(RESPONSE_FIELDS)
+    for n, request in requests:
+        try:
+            if isinstance(request, ValueError):
+                raise request
+            nat = request.get('nationality') or args.nat
+            gender = request.get('gender') or args.gender
+            if gender not in (None, MASCULINE, FEMININE):
+                raise ValueError("unknown gender '{}'".format(gender))
+            count = request.get('count')
+            if count in (None, ''):
+                count = 1
+            elif (isinstance(count, bool) or
+                  not isinstance(count, (int, str))):
+                raise ValueError("invalid count '{}'".format(count))
+            else:
+                try:
+                    count = int(count)
+                except ValueError:
+                    raise ValueError("invalid count '{}'".format(count))
+            if count < 0:
+                raise ValueError('count must not be negative')
+            corpus = request.get('corpus')
+            if corpus in (None, ''):
+                request_pools = pools
+            elif os.path.isfile(corpus):
+                request_pools = Corpus(corpus)
+            else:
+                # Don't build databases wherever requests say.
+                raise ValueError("no database '{}'".format(corpus))
+            key = request.get('key')
+            if key in (None, ''):
+                key = None
+                names = generate_many(count, nationality=nat, gender=gender,
+                                      pools=request_pools,
+                                      backend=(args.backend if args.batch
+                                               else 'python'),
+                                      romanisation=args.romanise,
+                                      constraints=constraints)
+            elif count != 1:
+                raise ValueError('a request with a key must have a count of '
+                                 '1')
+            else:
+                names = (name_for_key(key, nationality=nat, gender=gender,
+                                      salt=args.salt, pools=request_pools,
+                                      romanisation=args.romanise),)
+            for name, romanised, gender, nationality, _ in names:
+                with instrument.span('output'):
+                    response = (n, key, ' '.join(name),
+                                ' '.join(romanised) or None, gender,
+                                nationality)
+                    if fmt == 'jsonl':
+                        print(json.dumps(dict(zip(RESPONSE_FIELDS, response)),
+                                         ensure_ascii=False), file=outfile)
+                    else:
+                        writer.writerow(response)
+        except (ValueError, TypeError, sqlite3.Error) as e:
+            print('WARNING: skipping request {}: {}'.format(n, e),
+                  file=sys.stderr)
+        outfile.flush()
 
+def run(args):
+    '''Perform the action requested by the parsed arguments.'''
     # What are we doing?
-    if args.action == 'validate':
+    if args.import_corpus:
+        # We're importing extra names.
+        source, filename = args.import_corpus
+        if source not in DATA_COLUMNS:
+            raise SystemExit("unknown kind of name '{}'".format(source))
+        def progress(source, count):
+            if args.verbose > 1:
+                print('\t{} records read'.format(count))
+        import_corpus(filename, source, progress=progress,
+                      on_error=('skip' if args.skip_invalid else 'raise'),
+                      verbosity=args.verbose)
+    elif args.action == 'memprofile':
+        # We're measuring memory use. (The profiler is only imported here,
+        # as tracing support is slow to import.)
+        from namechoose import memprofile
+        profile = memprofile.profile_memory(
+            nationality=args.nat, gender=args.gender,
+            romanisation=args.romanise, count=args.count,
+            batch_sizes=(args.batch_sizes or
+                         memprofile.DEFAULT_BATCH_SIZES),
+            backend=args.backend, verbosity=args.verbose)
+        memprofile.report(profile, file=sys.stdout)
+        if args.memprofile_json:
+            with open(args.memprofile_json, mode='wt',
+                      encoding='utf-8') as jf:
+                memprofile.dump_json(profile, jf)
+    elif args.action == 'validate':
         # We're validating.
         if not args.skip_rebuild:
             # ...after rebuilding the database.
             build_db(verbosity=args.verbose)
         validate_data(verbosity=args.verbose)
+        if args.check_storage:
+            reference = backends.get_backend('sqlite')
+            for name in sorted(backends.BACKENDS):
+                # Make sure the snapshot reflects the validated database.
+                options = {'rebuild': True} if name == 'snapshot' else {}
+                with backends.get_backend(name, **options) as backend:
+                    check_backend(backend, reference, verbosity=args.verbose)
+                    timings = benchmark_backend(backend, seed=0)
+                print('{} backend: {:.3f} ms per query, {:.3f} ms per '
+                      'sample'.format(name, timings['query'] * 1000,
+                                      timings['sample'] * 1000))
     else:
         # We're generating.
+        backend = None
         try:
             # Choose the target for output, either stdout or a given file.
             target = sys.stdout
             if args.outfile:
                 target = open(args.outfile, encoding='utf-8',
                               mode=('wt' if args.overwrite else 'at'))
+            # Read names from the chosen storage backend, if any.
+            storage = args.storage or os.environ.get(backends.BACKEND_ENVVAR)
+            pools = None
+            if args.corpus:
+                pools = Corpus(args.corpus)
+            elif storage:
+                backend = backends.get_backend(storage)
+                pools = backend.pools()
+            get_engine_cache().set_limits(
+                max_engines=args.max_corpora,
+                max_bytes=(None if args.corpus_memory is None else
+                           max(1, int(args.corpus_memory * 2 ** 20))))
+            # Restrict the names chosen, if requested.
+            constraints = None
+            if (args.initial or args.max_length is not None or args.script or
+                args.deny):
+                deny = ()
+                if args.deny:
+                    with open(args.deny, encoding='utf-8') as df:
+                        deny = [line.strip() for line in df if line.strip()]
+                try:
+                    constraints = NameFilter(initials=args.initial,
+                                             max_length=args.max_length,
+                                             scripts=args.script,
+                                             exclude=deny)
+                except ValueError as ve:
+                    raise SystemExit(ve.args[0])
+            if args.stdin:
+                # Answer requests as they arrive, with the same pools.
+                serve_requests(sys.stdin, target, args, pools=pools,
+                               constraints=constraints)
+                return
             # Tell the user what's happening, if requested.
             if args.verbose:
                 print('Generating {} random {}{}'
@@ -103,24 +455,48 @@ def main():
                                           nat_lookup(args.nat) + ' '),
                                          's' if args.count > 1 else ''),
                       file=target)
-            # Perform the actual generation step(s).
-            for _ in range(args.count):
-                (name, romanised, gender, nationality,
-                 _) = generate(nationality=args.nat, gender=args.gender,
-                               verbosity=args.verbose)
-                # Yes, I know, Chinese names (for one) shouldn't have a space
-                # between their parts. Sorry.
-                print(' '.join(name), end='', file=target)
-                if len(romanised) > 0:
-                    print(' ({})'.format(' '.join(romanised)), end='',
-                          file=target)
-                if args.verbose:
-                    print(' ({}, {})'.format(gender, nationality), end='',
-                          file=target)
-                print(file=target)
+            # Perform the actual generation step(s). Constraints that no name
+            # can meet are reported before generating anything.
+            try:
+                if args.batch or args.mix:
+                    names = generate_many(args.count, nationality=args.nat,
+                                          gender=args.gender, pools=pools,
+                                          backend=(args.backend if args.batch
+                                                   else 'python'),
+                                          romanisation=args.romanise,
+                                          constraints=constraints,
+                                          mix=args.mix)
+                else:
+                    if constraints is not None:
+                        constrained_choices(constraints,
+                                            (None if args.nat is None else
+                                             nat_lookup(args.nat)),
+                                            args.gender, pools)
+                    names = (generate(nationality=args.nat,
+                                      gender=args.gender,
+                                      verbosity=args.verbose, pools=pools,
+                                      romanisation=args.romanise,
+                                      constraints=constraints)
+                             for _ in range(args.count))
+            except ValueError as ve:
+                raise SystemExit(ve.args[0])
+            for name, romanised, gender, nationality, _ in names:
+                with instrument.span('output'):
+                    # Yes, I know, Chinese names (for one) shouldn't have a
+                    # space between their parts. Sorry.
+                    print(' '.join(name), end='', file=target)
+                    if len(romanised) > 0:
+                        print(' ({})'.format(' '.join(romanised)), end='',
+                              file=target)
+                    if args.verbose:
+                        print(' ({}, {})'.format(gender, nationality), end='',
+                              file=target)
+                    print(file=target)
         finally:
             if args.outfile:
                 target.close()
+            if backend is not None:
+                backend.close()
 
 if __name__ == '__main__':
     main()